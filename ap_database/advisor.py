@@ -0,0 +1,125 @@
+# coding=utf-8
+__author__ = 'Shu Wang <wangshu214@live.cn>'
+__version__ = '0.0.0.1'
+__all__ = ['QueryAdvisor']
+__doc__ = 'Appointed2 - explain the slow queries and report the bad plans'
+from asyncio import Lock, CancelledError
+from ap_database.orm import translate_placeholders
+from ap_logger.logger import make_logger
+import aiomysql
+
+
+_advisor_logger = make_logger('ADVISOR')
+
+
+class QueryAdvisor(object):
+
+    """
+    执行时间超过阈值的查询, 每一种语句(占位符形式的 SQL)只在后台执行一次 EXPLAIN.
+    EXPLAIN 使用单独的连接, 不占用连接池. 标记全表扫描、filesort 以及临时表
+    """
+
+    def __init__(self, dbm, threshold=0.5, max_shapes=1024):
+        """
+        create an advisor
+        :param dbm: MySQLManager's instance, it provides the loop and open_connection
+        :param threshold: seconds, the queries slower than it are explained
+        :param max_shapes: maximum number of statements recorded
+        """
+        self.dbm = dbm
+        self.threshold = threshold
+        self.max_shapes = max_shapes
+        self._entries = dict()  # sql -> entry
+        self._tasks = set()
+        self._conn = None
+        self._lock = Lock()
+
+    def observe(self, sql, args, elapsed):
+        """
+        record the execution time of a select. called by the manager after every query
+        :param sql: sql
+        :param args: arguments for placeholders
+        :param elapsed: seconds
+        :return:
+        """
+        if elapsed < self.threshold or sql.lstrip()[:7].lower() == 'explain':
+            return
+        entry = self._entries.get(sql)
+        if entry is None:
+            if len(self._entries) >= self.max_shapes:
+                return
+            entry = {'sql': str(sql), 'count': 0, 'total_time': 0.0, 'max_time': 0.0, 'plan': None, 'problems': None, 'error': None}
+            self._entries[sql] = entry
+            task = self.dbm.loop.create_task(self._explain(sql, list(args) if args else [], entry))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        entry['count'] += 1
+        entry['total_time'] += elapsed
+        entry['max_time'] = max(entry['max_time'], elapsed)
+
+    async def _explain(self, sql, args, entry):
+        async with self._lock:  # 只有一个连接, EXPLAIN 依次执行
+            try:
+                if self._conn is None or self._conn.closed:
+                    self._conn = await self.dbm.open_connection()
+                async with self._conn.cursor(aiomysql.DictCursor) as cur:
+                    await cur.execute('explain ' + translate_placeholders(sql), args)
+                    plan = await cur.fetchall()
+            except CancelledError:
+                raise
+            except Exception as e:
+                entry['error'] = str(e)
+                _advisor_logger.warning('Failed to explain "%s": %s' % (sql, e))
+                return
+        entry['plan'] = [dict(r) for r in plan]
+        entry['problems'] = self.diagnose(plan)
+        if entry['problems']:
+            _advisor_logger.warning('Slow query (%.3fs) "%s": %s' % (entry['max_time'], sql, '; '.join(entry['problems'])))
+
+    @staticmethod
+    def diagnose(plan):
+        """
+        find the problems in the result of EXPLAIN
+        :param plan: list of dict, rows of EXPLAIN
+        :return: list of descriptions
+        """
+        problems = []
+        for r in plan:
+            table = r.get('table')
+            if r.get('type') == 'ALL':
+                problems.append('full table scan on %s (%s rows)' % (table, r.get('rows')))
+            extra = r.get('Extra') or ''
+            if 'Using filesort' in extra:
+                problems.append('filesort on %s' % table)
+            if 'Using temporary' in extra:
+                problems.append('temporary table on %s' % table)
+        return problems
+
+    def report(self):
+        """
+        the explained statements, the slowest in total first
+        :return: list of dict: sql, count, total_time, max_time, plan, problems, error. problems is None before EXPLAIN finishes
+        """
+        return sorted((dict(e) for e in self._entries.values()), key=lambda e: e['total_time'], reverse=True)
+
+    def dump(self):
+        """
+        write the statements which have problems into the log
+        :return:
+        """
+        for entry in self.report():
+            if entry['problems']:
+                _advisor_logger.warning('%d slow execution(s), total %.3fs, max %.3fs: %s\n    %s' % (
+                    entry['count'], entry['total_time'], entry['max_time'], entry['sql'], '\n    '.join(entry['problems'])))
+
+    async def close(self):
+        """
+        cancel the pending EXPLAIN, close the connection and dump the report
+        :return:
+        """
+        for task in list(self._tasks):
+            task.cancel()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self.dump()
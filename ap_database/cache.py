@@ -0,0 +1,135 @@
+# coding=utf-8
+__author__ = 'Shu Wang <wangshu214@live.cn>'
+__version__ = '0.0.0.1'
+__all__ = ['LRUCache', 'TTLCache']
+__doc__ = 'Appointed2 - in-process caches used by the ORM'
+from collections import OrderedDict
+from time import monotonic
+
+
+class LRUCache(object):
+
+    """
+    有容量限制的 LRU 缓存, 记录命中、未命中以及淘汰的次数. 只在事件循环的线程中使用, 不需要加锁
+    """
+
+    def __init__(self, maxsize=128):
+        """
+        create a cache
+        :param maxsize: maximum number of entries
+        """
+        if maxsize < 1:
+            raise ValueError('Invalid maxsize value: %s' % str(maxsize))
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        get the value and mark it as recently used
+        :param key:
+        :param default: returned when the key is missing
+        :return: value
+        """
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        put the value, the least recently used entry will be evicted if the cache is full
+        :param key:
+        :param value:
+        :return:
+        """
+        data = self._data
+        if key in data:
+            data.move_to_end(key)
+        data[key] = value
+        if len(data) > self.maxsize:
+            data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        remove an entry
+        :param key:
+        :return: True if the key exists
+        """
+        try:
+            del self._data[key]
+        except KeyError:
+            return False
+        return True
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        """
+        counters of the cache
+        :return: dict
+        """
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+
+class TTLCache(LRUCache):
+
+    """
+    每一项都有过期时间的 LRU 缓存. 过期的项在读取的时候删除, 记作未命中
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        """
+        create a cache
+        :param maxsize: maximum number of entries
+        :param ttl: seconds before an entry expires
+        """
+        super(TTLCache, self).__init__(maxsize=maxsize)
+        if ttl <= 0:
+            raise ValueError('Invalid ttl value: %s' % str(ttl))
+        self.ttl = ttl
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        entry = super(TTLCache, self).get(key)
+        if entry is None:
+            return default
+        expire_at, value = entry
+        if expire_at < monotonic():
+            del self._data[key]
+            self.hits -= 1
+            self.misses += 1
+            self.expirations += 1
+            return default
+        return value
+
+    def set(self, key, value):
+        super(TTLCache, self).set(key, (monotonic() + self.ttl, value))
+
+    def stats(self):
+        stats = super(TTLCache, self).stats()
+        stats['ttl'] = self.ttl
+        stats['expirations'] = self.expirations
+        return stats
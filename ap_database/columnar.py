@@ -0,0 +1,50 @@
+# coding=utf-8
+__author__ = 'Shu Wang <wangshu214@live.cn>'
+__version__ = '0.0.0.1'
+__all__ = ['to_columns']
+__doc__ = 'Appointed2 - columnar results as numpy arrays for analytical queries'
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('numpy is required by the columnar result, please install it with "pip install numpy"')
+    return numpy
+
+
+def _column_fields(model_type, columns):
+    """
+    find the field of every column in the result
+    :param model_type: model class
+    :param columns: names of the columns
+    :return: list of Field or None
+    """
+    mappings = model_type.__mappings__
+    by_name = {field.name or k: field for k, field in mappings.items()}  # 临时表的结果使用字段的名称
+    return [mappings.get(c) or by_name.get(c) for c in columns]
+
+
+def _to_array(np, values, dtype):
+    if dtype != 'object' and not dtype.startswith('float') and not dtype.startswith('datetime') and None in values:
+        # NULL 不能保存在整数和布尔的数组中. 整数使用 NaN 表示, 布尔使用 object
+        if dtype.startswith('int'):
+            return np.array([np.nan if v is None else v for v in values], dtype='float64')
+        return np.array(values, dtype=object)
+    return np.array(values, dtype=dtype)
+
+
+def to_columns(model_type, rows, columns):
+    """
+    convert the rows into numpy arrays, one for each column. the type of the array is the dtype of the field
+    :param model_type: model class
+    :param rows: list of tuples
+    :param columns: names of the columns in the tuples
+    :return: dict, column name -> numpy array
+    """
+    np = _import_numpy()
+    values = list(zip(*rows)) if rows else [()] * len(columns)
+    result = dict()
+    for c, field, v in zip(columns, _column_fields(model_type, columns), values):
+        result[c] = _to_array(np, v, field.dtype if field is not None else 'object')
+    return result
@@ -4,16 +4,86 @@ __version__ = '0.0.0.1'
 __all__ = ["MySQLManager", "SQLManager"]
 __doc__ = 'Appointed2 - SQL manager'
 from ap_database.orm import ModelMetaclass, Model, TempModelMetaclass, TempModel, ViewTableMetaclass, ViewTable, BasicModel
+from ap_database.orm import translate_placeholders, statement_cache
+from ap_database.session import Session
+from ap_database.loader import PrimaryKeyLoader
+from ap_database.singleflight import SingleFlight
+from ap_database.advisor import QueryAdvisor
+from ap_database.pipeline import Pipeline
+from ap_database.telemetry import PoolMonitor
 from ap_logger.logger import make_logger
-from asyncio import get_event_loop
+from asyncio import get_event_loop, gather, sleep, Lock, CancelledError
+from pymysql.constants import CLIENT
+from time import monotonic
+from weakref import WeakKeyDictionary
 import aiomysql
 import abc
 
 import sys
 if sys.version_info[:2] <= (3, 6):
     from async_generator import async_generator, asynccontextmanager  # for python 3.6
+    from asyncio import Task
+    current_task = Task.current_task
 else:
     from contextlib import asynccontextmanager  # python3.7
+    from asyncio import current_task
+    from contextvars import ContextVar
+
+
+class _TaskLocal(object):
+
+    """
+    python 3.6 的 asyncio 的 task 没有各自的 contextvars 上下文, 所有的 task 共享一个值. 这时以 task 为键保存,
+    接口与 ContextVar 的 get, set 和 reset 相同. 注意新创建的 task 不继承创建它的 task 的值
+    """
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self._default = default
+        self._values = WeakKeyDictionary()  # task -> 值
+
+    @staticmethod
+    def _task():
+        try:
+            return current_task()
+        except RuntimeError:
+            return None  # 没有运行中的事件循环
+
+    def get(self):
+        task = self._task()
+        return self._values.get(task, self._default) if task is not None else self._default
+
+    def set(self, value):
+        task = self._task()
+        if task is None:
+            return None  # 不在 task 中, 没有可以保存的地方
+        token = (task, self._values.get(task, self._default))
+        self._values[task] = value
+        return token
+
+    def reset(self, token):
+        if token is not None:
+            task, value = token
+            self._values[task] = value
+
+
+if sys.version_info[:2] <= (3, 6):
+    ContextVar = _TaskLocal
+
+
+class _PinnedConnection(object):
+
+    """
+    transaction 或者 connection 固定的连接. 只有创建它的 task 使用, 这个 task 创建的其他 task 仍然从连接池获取连接
+    """
+
+    def __init__(self, conn, in_transaction):
+        self.conn = conn
+        self.in_transaction = in_transaction
+        self.savepoints = 0  # 嵌套的 transaction 使用的保存点的数量
+        self.task = current_task()
+        self.closed = False
+        self.after_commit = []  # 提交之后执行的回调, 例如清空缓存. 回滚的时候丢弃
 
 
 class SQLManager(object):
@@ -25,6 +95,10 @@ class SQLManager(object):
     async def insert(self, model_type_or_object, **fields_include_primary_keys):
         pass
 
+    @abc.abstractmethod
+    async def insert_many(self, model_type, objs, **kwargs):
+        pass
+
     @abc.abstractmethod
     async def query(self, model_type, **obj_primaryKeys):
         pass
@@ -34,7 +108,15 @@ class SQLManager(object):
         pass
 
     @abc.abstractmethod
-    async def update(self, model_type_or_object, **kwargs):
+    async def update(self, model_type_or_object, ignore_not_exists=False, use_upsert=False, **kwargs):
+        pass
+
+    @abc.abstractmethod
+    async def upsert(self, model_type_or_object, update_fields=None, **kwargs):
+        pass
+
+    @abc.abstractmethod
+    async def upsert_many(self, model_type, objs, **kwargs):
         pass
 
     @abc.abstractmethod
@@ -46,7 +128,7 @@ class SQLManager(object):
         pass
 
     @abc.abstractmethod
-    async def inner_select(self, sql, args, size=None, **kwargs):
+    async def inner_select(self, sql, args, size=None, cursor='dict', **kwargs):
         """
         select adapter
         :param pool:
@@ -61,6 +143,10 @@ class SQLManager(object):
     async def inner_execute(self, sql, args, autocommit=True, **kwargs):
         pass
 
+    @abc.abstractmethod
+    async def inner_execute_many(self, statements, **kwargs):
+        pass
+
     @abc.abstractmethod
     async def close(self):
         pass
@@ -70,7 +156,11 @@ class SQLManager(object):
         pass
 
     @abc.abstractmethod
-    async def countNum(self, model_type, sql_where=None, args=None):
+    async def countNum(self, model_type, sql_where=None, args=None, **kwargs):
+        pass
+
+    @abc.abstractmethod
+    async def aggregate(self, model_type, sql_where=None, args=None, **kwargs):
         pass
 
 
@@ -81,7 +171,8 @@ class MySQLManager(SQLManager):
     """
     SQL_LOGGER = make_logger('MYSQLMGR')
 
-    def __init__(self, username, password, dbname, host, port, loop=None):
+    def __init__(self, username, password, dbname, host, port, loop=None, batch_primary_keys=False, coalesce_reads=False, slow_query_threshold=None,
+                 replicas=None, read_your_writes=True, multi_statements=False, pool_recycle=-1, max_lifetime=None):
         """
         创建一个对象
         :param username: 数据库连接的名称
@@ -90,6 +181,17 @@ class MySQLManager(SQLManager):
         :param host: 主机地址
         :param port: 端口
         :param loop: 事件循环
+        :param batch_primary_keys: query 在同一轮事件循环中的主键查询合并为一条 where pk in (...) 的查询
+        :param coalesce_reads: inner_select 中 SQL 和参数都相同的查询同时只执行一次, 其他的查询共享结果
+        :param slow_query_threshold: 秒. 执行时间超过这个值的查询在后台执行一次 EXPLAIN, 参考 advisor_report. None 表示关闭
+        :param replicas: 只读副本的列表, 每一项是 (host, port) 或者 dict(host=, port=, username=, password=). inner_select 和
+        inner_select_on_large 使用进行中的请求最少的副本, 写入使用主库
+        :param read_your_writes: 写入之后, 当前的上下文(例如一个请求的 task)中的读取都使用主库, 参考 pin_primary
+        :param multi_statements: pipeline 中的查询作为一条多语句发送. 只有主库上单独的只读连接池(connect 的 pipeline_maxsize, 默认 2)
+        开启 CLIENT.MULTI_STATEMENTS, 其他的连接不受影响. 否则 pipeline 并发地执行每一个查询
+        :param pool_recycle: 秒. 空闲的连接超过这个时间之后在下一次获取的时候重新连接, -1 表示不回收.
+        注意 warm_up 的 keepalive 的 ping 会刷新空闲的时间, 这时需要使用 max_lifetime
+        :param max_lifetime: 秒. keepalive 关闭打开的时间超过这个值的空闲的连接, 连接池之后打开新的连接. None 表示不限制
         """
         super(MySQLManager, self).__init__()
         self.username = username
@@ -101,6 +203,28 @@ class MySQLManager(SQLManager):
         self.loop = loop
         if not loop:
             self.loop = get_event_loop()
+        self.batch_primary_keys = batch_primary_keys
+        self._loaders = dict()  # Model -> PrimaryKeyLoader
+        self.singleflight = SingleFlight(self.loop) if coalesce_reads else None
+        self.advisor = QueryAdvisor(self, slow_query_threshold) if slow_query_threshold is not None else None
+        self._connect_kwargs = dict()
+        self._replicated = set()  # 加载到内存中的模型
+        self.replicas = [r if isinstance(r, dict) else dict(host=r[0], port=r[1]) for r in replicas or ()]
+        self.replica_pools = []  # (副本, 连接池)
+        self.pool_monitor = None  # 主库的连接池的统计
+        self.pipeline_pool = None  # multi_statements 的时候 pipeline 使用的只读连接池
+        self.pipeline_monitor = None
+        self._replica_monitors = []
+        self._outstanding = []  # 每一个副本上进行中的请求
+        self._replica_reads = []
+        self.read_your_writes = read_your_writes
+        self.multi_statements = multi_statements
+        self.pool_recycle = pool_recycle
+        self.max_lifetime = max_lifetime
+        self._connect_lock = None  # 保证并发的第一次请求只创建一个连接池
+        self._keepalive = None
+        self._pinned = ContextVar('ap_database_pin_primary_%d' % id(self), default=False)
+        self._connection = ContextVar('ap_database_connection_%d' % id(self), default=None)  # _PinnedConnection
 
     async def close(self):
         """
@@ -108,51 +232,351 @@ class MySQLManager(SQLManager):
         :return:
         """
         self.SQL_LOGGER.debug('Closing a database connection pool...')
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+            self._keepalive = None
+        if self.advisor is not None:
+            await self.advisor.close()
+        for model_type in self._replicated:
+            model_type.__replica__.stop()
+        self._replicated.clear()
         if self.pool is not None:
             self.pool.close()
             await self.pool.wait_closed()
         self.pool = None
+        for _, pool in self.replica_pools:
+            pool.close()
+            await pool.wait_closed()
+        self.replica_pools, self._outstanding, self._replica_reads = [], [], []
+        if self.pipeline_pool is not None:
+            self.pipeline_pool.close()
+            await self.pipeline_pool.wait_closed()
+        self.pipeline_pool = None
+        self.pool_monitor, self._replica_monitors, self.pipeline_monitor = None, [], None
 
     async def connect(self, **kwargs):
         self.SQL_LOGGER.debug('Creating a database connection pool...')
-        self.pool = await aiomysql.create_pool(
-            host=self.host,
-            port=self.port,
-            user=self.username,
-            password=self.password,
+        self._connect_kwargs = kwargs
+        primary = await self._create_pool(self.host, self.port, self.username, self.password, **kwargs)
+        pools = []
+        for replica in self.replicas:
+            try:
+                pool = await self._create_pool(replica['host'], replica['port'], replica.get('username', self.username),
+                                               replica.get('password', self.password), **kwargs)
+            except Exception as e:
+                self.SQL_LOGGER.warning('Failed to connect the replica %s:%s, it is skipped: %s' % (replica['host'], replica['port'], e))
+                continue
+            pools.append((replica, pool))
+        self.replica_pools, self._outstanding, self._replica_reads = pools, [0] * len(pools), [0] * len(pools)
+        self._replica_monitors = [PoolMonitor(pool) for _, pool in pools]
+        if self.multi_statements:
+            try:
+                self.pipeline_pool = await self._create_pool(self.host, self.port, self.username, self.password, multi_statements=True,
+                                                             **dict(kwargs, minsize=1, maxsize=kwargs.get('pipeline_maxsize', 2)))
+                self.pipeline_monitor = PoolMonitor(self.pipeline_pool)
+            except Exception as e:
+                self.SQL_LOGGER.warning('Failed to create the pool of the pipeline, the queries are executed concurrently: %s' % e)
+        self.pool, self.pool_monitor = primary, PoolMonitor(primary)  # 最后设置, 其他的调用者看到的连接池是完整的
+
+    async def _create_pool(self, host, port, username, password, multi_statements=False, **kwargs):
+        """
+        create a pool
+        :param multi_statements: the read-only pool of the pipeline, CLIENT.MULTI_STATEMENTS is set and the sessions can not write
+        :param kwargs: arguments of connect
+        :return: aiomysql pool
+        """
+        return await aiomysql.create_pool(
+            host=host,
+            port=port,
+            user=username,
+            password=password,
             db=self.dbname,
             charset=kwargs.get('charset', 'utf8'),
             # http://www.liaoxuefeng.com/discuss/001409195742008d822b26cf3de46aea14f2b7378a1ba91000/001451894920450a22651047f7f4a4ca2d0aea99d1452a2000
             autocommit=kwargs.get('autocommit', True),
             maxsize=kwargs.get('maxsize', 10),
             minsize=kwargs.get('minsize', 1),
+            client_flag=CLIENT.MULTI_STATEMENTS if multi_statements else 0,
+            init_command='set session transaction read only' if multi_statements else None,  # 多语句中不能附加写入
+            pool_recycle=kwargs.get('pool_recycle', self.pool_recycle),
             loop=self.loop
         )
 
+    @asynccontextmanager
+    async def _acquire(self, read=False):
+        """
+        get a connection. reads use the replica with the least outstanding requests, unless the context is pinned to the primary
+        :param read: the connection is only used to read
+        :return: async context manager of the connection
+        """
+        pinned = self._active_connection()
+        if pinned is not None:
+            yield pinned.conn  # transaction 或者 connection 中的所有语句使用同一个连接
+        elif read and self.replica_pools and not self._pinned.get():
+            outstanding = self._outstanding
+            i = min(range(len(outstanding)), key=outstanding.__getitem__)
+            outstanding[i] += 1
+            self._replica_reads[i] += 1
+            try:
+                async with self._replica_monitors[i].acquire() as conn:
+                    yield conn
+            finally:
+                outstanding[i] -= 1
+        else:
+            async with self.pool_monitor.acquire() as conn:
+                yield conn
+
+    def _active_connection(self):
+        """
+        the connection pinned by transaction or connection in the current task
+        :return: _PinnedConnection or None
+        """
+        pinned = self._connection.get()
+        if pinned is None or pinned.closed or pinned.task is not current_task():
+            return None
+        return pinned
+
+    @property
+    def in_transaction(self):
+        """
+        whether the current task is in a transaction
+        :return: bool
+        """
+        pinned = self._active_connection()
+        return pinned is not None and pinned.in_transaction
+
+    @asynccontextmanager
+    async def connection(self):
+        """
+        all the statements in the block of the current task use one connection of the primary,
+        e.g. async with dbm.connection(): ... the statements are still committed one by one
+        :return: async context manager
+        """
+        if self._active_connection() is not None:
+            yield self
+            return
+        await self.ensureConnected()
+        async with self._acquire() as conn:
+            pinned = _PinnedConnection(conn, False)
+            token = self._connection.set(pinned)
+            try:
+                yield self
+            finally:
+                pinned.closed = True
+                self._connection.reset(token)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        all the statements in the block of the current task use one connection, committed at the end
+        or rolled back if an exception is raised. a nested transaction uses a savepoint.
+        note that the tasks created in the block (e.g. asyncio.gather) do not join the transaction
+        :return: async context manager
+        """
+        pinned = self._active_connection()
+        if pinned is not None and pinned.in_transaction:
+            pinned.savepoints += 1
+            name = 'ap_savepoint_%d' % pinned.savepoints
+            queued = len(pinned.after_commit)
+            async with pinned.conn.cursor() as cur:
+                await cur.execute('savepoint %s' % name)
+            try:
+                yield self
+            except BaseException:
+                async with pinned.conn.cursor() as cur:
+                    await cur.execute('rollback to savepoint %s' % name)
+                del pinned.after_commit[queued:]  # 回滚的写入不需要清空缓存
+                raise
+            else:
+                async with pinned.conn.cursor() as cur:
+                    await cur.execute('release savepoint %s' % name)
+            finally:
+                pinned.savepoints -= 1
+            return
+        async with self.connection():
+            pinned = self._active_connection()
+            pinned.in_transaction = True
+            await pinned.conn.begin()
+            try:
+                yield self
+            except BaseException:
+                await pinned.conn.rollback()
+                raise
+            else:
+                await pinned.conn.commit()
+            finally:
+                pinned.in_transaction = False
+                callbacks, pinned.after_commit = pinned.after_commit, []
+            for callback in callbacks:  # 只有提交成功才会执行到这里
+                try:
+                    callback()
+                except Exception as e:
+                    self.SQL_LOGGER.warning('Failed to run the callback after commit: %s' % e)
+
+    def after_commit(self, callback):
+        """
+        run the callback after the transaction of the current task is committed, or now if there is no transaction.
+        the callback is dropped if the transaction (or the savepoint around it) is rolled back
+        :param callback: callable without arguments
+        :return:
+        """
+        pinned = self._active_connection()
+        if pinned is not None and pinned.in_transaction:
+            pinned.after_commit.append(callback)
+        else:
+            callback()
+
+    def pin_primary(self, pinned=True):
+        """
+        read from the primary in the current context (the task of a request and the tasks it creates later, only the task itself on python 3.6).
+        it is called automatically after writes if read_your_writes is set
+        :param pinned: False to read from the replicas again
+        :return:
+        """
+        self._pinned.set(pinned)
+
+    @property
+    def connection_pinned(self):
+        """
+        whether the current task uses the connection pinned by transaction or connection
+        :return: bool
+        """
+        return self._active_connection() is not None
+
+    @property
+    def primary_pinned(self):
+        """
+        whether the reads of the current context go to the primary, see pin_primary
+        :return: bool
+        """
+        return self._pinned.get()
+
+    def pool_stats(self):
+        """
+        gauges (size, free, in use, waiting and their high-water marks) and histograms (acquire wait time and hold time, in seconds)
+        of the pools, see ap_database.telemetry.PoolMonitor
+        :return: dict: primary, replicas and pipeline (None without multi_statements), None if not connected
+        """
+        if self.pool_monitor is None:
+            return None
+        replicas = []
+        for (replica, _), monitor in zip(self.replica_pools, self._replica_monitors):
+            stats = monitor.stats()
+            stats['host'], stats['port'] = replica['host'], replica['port']
+            replicas.append(stats)
+        return {'primary': self.pool_monitor.stats(), 'replicas': replicas,
+                'pipeline': self.pipeline_monitor.stats() if self.pipeline_monitor is not None else None}
+
+    def reset_pool_high_water(self):
+        """
+        reset the high-water marks, e.g. after reading them periodically
+        :return:
+        """
+        for monitor in [self.pool_monitor, self.pipeline_monitor] + self._replica_monitors:
+            if monitor is not None:
+                monitor.reset_high_water()
+
+    def replica_stats(self):
+        """
+        counters of the replicas
+        :return: list of dict: host, port, outstanding, reads
+        """
+        return [{'host': replica['host'], 'port': replica['port'], 'outstanding': outstanding, 'reads': reads}
+                for (replica, _), outstanding, reads in zip(self.replica_pools, self._outstanding, self._replica_reads)]
+
+    async def open_connection(self):
+        """
+        open a connection outside the pool, with the same settings. the caller must close it
+        :return: aiomysql connection
+        """
+        return await aiomysql.connect(
+            host=self.host,
+            port=self.port,
+            user=self.username,
+            password=self.password,
+            db=self.dbname,
+            charset=self._connect_kwargs.get('charset', 'utf8'),
+            autocommit=True,
+            loop=self.loop
+        )
+
+    def advisor_report(self):
+        """
+        the slow queries and the problems found by EXPLAIN, see QueryAdvisor.report
+        :return: list of dict or None if slow_query_threshold is not set
+        """
+        return self.advisor.report() if self.advisor is not None else None
+
     @property
     def connected(self):
         return self.pool is not None
 
-    async def inner_select(self, sql, args, size=None, **kwargs):
+    async def inner_select(self, sql, args, size=None, cursor='dict', **kwargs):
         """
         perform a select operation. the default is DictCursor which is return a dict object.
         :param pool: connection pool
-        :param sql: sql, placeholder is ?
+        :param sql: sql, placeholder is ?. CompiledSQL is passed to the driver directly
         :param args: arguments for placeholders
         :param size: limited size
-        :return: result, format is based on the type of cursor
+        :param cursor: 'dict' uses DictCursor; 'tuple' uses Cursor which returns tuples
+        :return: result, format is based on the type of cursor. the result may be shared by the coalesced queries, do not modify it
         """
+        if self.singleflight is not None and self._active_connection() is None:  # 事务中的读取不与其他的读取合并
+            try:
+                key = (sql, tuple(args) if args else (), size, cursor, self._pinned.get())
+                hash(key)
+            except TypeError:
+                key = None  # 参数不能作为键, 不合并
+            if key is not None:
+                return await self.singleflight.do(key, lambda: self._inner_select(sql, args, size, cursor, **kwargs))
+        return await self._inner_select(sql, args, size, cursor, **kwargs)
+
+    async def _inner_select(self, sql, args, size=None, cursor='dict', **kwargs):
         self.SQL_LOGGER.debug('Perform: %s' % sql)
-        async with self.pool.get() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args or ())
+        async with self._acquire(read=True) as conn:
+            async with conn.cursor(aiomysql.Cursor if cursor == 'tuple' else aiomysql.DictCursor) as cur:
+                start = monotonic()
+                await cur.execute(translate_placeholders(sql), args or ())
                 if size:
                     rs = await cur.fetchmany(size)
                 else:
                     rs = await cur.fetchall()
+                if self.advisor is not None:
+                    self.advisor.observe(sql, args, monotonic() - start)
                 self.SQL_LOGGER.debug('Row effected: %s' % cur.rowcount)
             return rs
 
+    async def inner_select_many(self, statements, **kwargs):
+        """
+        perform several independent selects. with multi_statements they are sent as one multi-statement query on a connection of
+        the pipeline pool, otherwise they are executed concurrently on the connections of the pool (or one by one on the pinned connection)
+        :param statements: list of (sql, args, cursor), placeholder is ?, cursor is 'dict' or 'tuple'
+        :return: list of the results
+        """
+        if self._active_connection() is not None:  # transaction 中的读取需要看到自己的写入
+            return [await self.inner_select(sql, args, cursor=cursor) for sql, args, cursor in statements]
+        if self.pipeline_monitor is None:
+            return list(await gather(*[self.inner_select(sql, args, cursor=cursor) for sql, args, cursor in statements]))
+        results = []
+        async with self.pipeline_monitor.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                sql = ';\n'.join(cur.mogrify(translate_placeholders(sql), args or ()) for sql, args, _ in statements)
+                self.SQL_LOGGER.debug('Perform %d statement(s): %s' % (len(statements), sql))
+                await cur.execute(sql)
+                for i, (_, _, cursor) in enumerate(statements):
+                    rs = await cur.fetchall()
+                    results.append([tuple(r.values()) for r in rs] if cursor == 'tuple' else rs)  # 所有的结果使用同一个游标
+                    if i + 1 < len(statements):
+                        await cur.nextset()
+        return results
+
+    def pipeline(self):
+        """
+        create a pipeline which sends several independent queries together, see ap_database.pipeline.Pipeline
+        :return: Pipeline
+        """
+        return Pipeline(self)
+
     async def inner_execute(self, sql, args, autocommit=True, *kwargs):
         """
         This is proxy for performing the insert, update, delete on table
@@ -163,12 +587,14 @@ class MySQLManager(SQLManager):
         :return: return the number of affected rows
         """
         self.SQL_LOGGER.debug(sql)
-        async with self.pool.get() as conn:
+        if not autocommit and self.in_transaction:
+            autocommit = True  # 由 transaction 提交
+        async with self._acquire() as conn:
             if not autocommit:
                 await conn.begin()
             try:
                 async with conn.cursor(aiomysql.DictCursor) as cur:
-                    await cur.execute(sql.replace('?', '%s'), args)
+                    await cur.execute(translate_placeholders(sql), args)
                     affected = cur.rowcount
                 if not autocommit:
                     await conn.commit()  # 如果没有自动保存修改就会立即修改
@@ -176,10 +602,44 @@ class MySQLManager(SQLManager):
                 if not autocommit:
                     await conn.rollback()
                 raise
-            return affected
+        if self.read_your_writes:
+            self._pinned.set(True)
+        return affected
+
+    async def inner_execute_many(self, statements, **kwargs):
+        """
+        perform several insert, update, delete statements on one connection in one transaction
+        :param statements: iterable of (sql, args), placeholder is ?
+        :return: list of affected rows of every statement
+        """
+        results = []
+        if self.in_transaction:
+            async with self.transaction():  # 在外层的事务中使用保存点
+                async with self._acquire() as conn:
+                    async with conn.cursor() as cur:
+                        for sql, args in statements:
+                            self.SQL_LOGGER.debug(sql)
+                            await cur.execute(translate_placeholders(sql), args)
+                            results.append(cur.rowcount)
+        else:
+            async with self._acquire() as conn:
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        for sql, args in statements:
+                            self.SQL_LOGGER.debug(sql)
+                            await cur.execute(translate_placeholders(sql), args)
+                            results.append(cur.rowcount)
+                    await conn.commit()
+                except BaseException:
+                    await conn.rollback()
+                    raise
+        if self.read_your_writes:
+            self._pinned.set(True)
+        return results
 
     @asynccontextmanager
-    async def inner_select_on_large(self, sql, args, **kwargs):
+    async def inner_select_on_large(self, sql, args, cursor='dict', **kwargs):
         """
         query large data with stream cursor. please ensure the connection by call the method 'ensureConnected'
         需要注意的是 https://blog.csdn.net/weixin_41287692/article/details/83545891
@@ -190,20 +650,125 @@ class MySQLManager(SQLManager):
         :param sql: sql, the format of placeholders is ?
         :param args: arguments for placeholder
         :param async_map_callback: asynchronous unary closure for format the data in result
+        :param cursor: 'dict' uses SSDictCursor; 'tuple' uses SSCursor which returns tuples
         :return:return an instance of DictCursor in async contextmanager, you can call async method fetchone, fetchmany.
         """
+        if self._active_connection() is not None:
+            # 其他的语句使用同一个连接的时候, aiomysql 会读取并丢弃剩余的结果, 迭代提前结束
+            raise RuntimeError('Streaming is not available in transaction() or connection(), the other statements share the connection. '
+                               'please use iter_all (it pages instead) or query_page')
         self.SQL_LOGGER.debug('Perform: %s' % sql)
-        async with self.pool.get() as conn:
-            async with conn.cursor(aiomysql.SSDictCursor) as cur:  # stream and dict cursor
-                await cur.execute(sql.replace('?', '%s'), args or ())
+        async with self._acquire(read=True) as conn:
+            async with conn.cursor(aiomysql.SSCursor if cursor == 'tuple' else aiomysql.SSDictCursor) as cur:  # stream and dict cursor
+                await cur.execute(translate_placeholders(sql), args or ())
                 try:
                     yield cur
                 finally:
                     await cur.close()
 
-    async def ensureConnected(self):
-        if not self.connected:
-            await self.connect()
+    def session(self):
+        """
+        create a session with identity map and unit of work. see ap_database.session.Session
+        :return: Session
+        """
+        return Session(self)
+
+    def coalescing_stats(self):
+        """
+        counters of the coalesced read queries
+        :return: dict or None if coalesce_reads is disabled
+        """
+        return self.singleflight.stats() if self.singleflight is not None else None
+
+    def statement_cache_stats(self):
+        """
+        counters of the compiled statement cache shared by all the models
+        :return: dict, including hit_rate
+        """
+        return statement_cache.stats()
+
+    async def ensureConnected(self, **kwargs):
+        """
+        create the pool if it does not exist. the concurrent callers wait for the same pool
+        :param kwargs: arguments of connect
+        :return:
+        """
+        if self.connected:
+            return
+        if self._connect_lock is None:
+            self._connect_lock = Lock()
+        async with self._connect_lock:
+            if not self.connected:
+                await self.connect(**kwargs)
+
+    def _monitors(self):
+        return ([self.pool_monitor] if self.pool_monitor is not None else []) + self._replica_monitors + \
+            ([self.pipeline_monitor] if self.pipeline_monitor is not None else [])
+
+    async def _open(self, monitor, num):
+        """
+        hold num connections of a pool at the same time and ping them, so the pool has to open that many connections
+        :param monitor: PoolMonitor of the pool, the checkouts are not recorded as acquires
+        :param num: number of connections
+        :return: number of connections opened
+        """
+        if num <= 0:
+            return 0
+        async with monitor.pool.acquire() as conn:  # 维护连接不计入获取次数和等待/占用时间
+            monitor.touch(conn)
+            await conn.ping(reconnect=True)
+            return 1 + await self._open(monitor, num - 1)
+
+    async def _ping_idle(self, monitor, num):
+        """
+        ping the idle connections of a pool one by one, and close the ones older than max_lifetime.
+        the released connection is put at the end of the free list
+        :param monitor: PoolMonitor of the pool, the checkouts are not recorded as acquires
+        :param num: number of connections to ping
+        :return: (number of connections pinged, number of connections closed)
+        """
+        pinged = closed = 0
+        for _ in range(num):
+            async with monitor.pool.acquire() as conn:  # 维护连接不计入获取次数和等待/占用时间
+                monitor.touch(conn)
+                if self.max_lifetime is not None and monitor.age(conn) > self.max_lifetime:
+                    conn.close()  # 关闭的连接不会回到连接池
+                    closed += 1
+                else:
+                    await conn.ping(reconnect=True)
+                    pinged += 1
+        return pinged, closed
+
+    async def warm_up(self, keepalive_interval=None, **kwargs):
+        """
+        create the pools and open minsize connections of every pool, validated with ping. call it when the app starts,
+        so the first requests do not pay for the handshakes
+        :param keepalive_interval: seconds, ping the idle connections periodically
+        :param kwargs: arguments of connect, e.g. minsize, maxsize, pool_recycle
+        :return: number of connections opened
+        """
+        await self.ensureConnected(**kwargs)
+        opened = 0
+        monitors = self._monitors()
+        for monitor in monitors:
+            opened += await self._open(monitor, monitor.pool.minsize)
+        self.SQL_LOGGER.info('Warm up %d connection(s) in %d pool(s)' % (opened, len(monitors)))
+        if keepalive_interval and self._keepalive is None:
+            self._keepalive = self.loop.create_task(self._keep_alive(keepalive_interval))
+        return opened
+
+    async def _keep_alive(self, interval):
+        while True:
+            await sleep(interval)
+            for monitor in self._monitors():
+                try:
+                    _, closed = await self._ping_idle(monitor, monitor.pool.freesize)
+                    if closed:
+                        self.SQL_LOGGER.debug('Close %d connection(s) older than %s second(s)' % (closed, self.max_lifetime))
+                except CancelledError:
+                    raise
+                except Exception as e:
+                    self.SQL_LOGGER.warning('Failed to ping the idle connections: %s' % e)
 
     async def insert(self, model_type_or_object, **fields_include_primary_keys):
         """
@@ -225,6 +790,19 @@ class MySQLManager(SQLManager):
         else:
             raise ValueError(str(model_type_or_object) + '不是 "Model"的一个子类。')
 
+    async def insert_many(self, model_type, objs, **kwargs):
+        """
+        批量写入数据, 每一批使用一条多行的 insert 语句
+        :param model_type: Model 的子类
+        :param objs: Model 的实例或者 dict 构成的可迭代对象
+        :param kwargs: batch_rows 表示每一批最多的行数; batch_bytes 表示每一批参数的大约字节数
+        :return: 每一批受影响的行数
+        """
+        await self.ensureConnected()
+        if not isinstance(model_type, ModelMetaclass):
+            raise ValueError(str(model_type) + '不是 "Model"的一个子类。')
+        return await model_type.insert_many(self, objs, **kwargs)
+
     async def query(self, model_type, **obj_primaryKeys):
         """
         查询一个表中的条目，返回ORM ： model_type的类。 由于视图目前不支持修改以及没有主码， 所以这个函数不适合 视图
@@ -235,9 +813,23 @@ class MySQLManager(SQLManager):
         await self.ensureConnected()
         # if not isinstance(model_type, BasicModel):  # 只有元类的实例才判断继承关系
         #     raise ValueError(str(model_type) + '不是 "BasicModel" 的一个子类。该类必须支持投影操作')
+        if self.batch_primary_keys and isinstance(model_type, ModelMetaclass) and self._active_connection() is None:
+            return await self.loader(model_type).load(**obj_primaryKeys)
         obj = await model_type.query_with_primary_keys(dbm=self, **obj_primaryKeys)  # 视图会自动出错
         return obj
 
+    def loader(self, model_type):
+        """
+        get the loader which batches the primary key lookups of the model in the same tick
+        :param model_type: subclass of Model
+        :return: PrimaryKeyLoader
+        """
+        loader = self._loaders.get(model_type)
+        if loader is None:
+            loader = PrimaryKeyLoader(self, model_type)
+            self._loaders[model_type] = loader
+        return loader
+
     async def delete(self, model_type_or_object, **obj_primaryKeys):
         """
         删除一个条目
@@ -248,7 +840,7 @@ class MySQLManager(SQLManager):
         await self.ensureConnected()
         if isinstance(model_type_or_object, Model):
             # 是Model的字类的实例
-            await model_type_or_object.query_with_primary_keys(self)
+            await model_type_or_object.delete(self)
         elif isinstance(model_type_or_object, ModelMetaclass):
             # 是Model的元类
             obj = await self.query(model_type_or_object, **obj_primaryKeys)
@@ -258,15 +850,18 @@ class MySQLManager(SQLManager):
         else:
             raise ValueError(str(model_type_or_object) + '不是 "Model"的一个子类。')
 
-    async def update(self, model_type_or_object, ignore_not_exists=False, **kwargs):
+    async def update(self, model_type_or_object, ignore_not_exists=False, use_upsert=False, **kwargs):
         """
         更新对象或者数据库中的条目(主键除外)
         :param model_type_or_object: Model的子类实例或者是Metalass 的子类
         :param ignore_not_exists: 为 True 在不存在的这个对象的时候创建一个新的对象；否则抛出异常
+        :param use_upsert: 与 ignore_not_exists 同时为 True 的时候使用 insert ... on duplicate key update, 只需要一次往返
         :param kwargs: 更新的主键以及其他的属性
         :return:
         """
         await self.ensureConnected()
+        if ignore_not_exists and use_upsert:
+            return await self.upsert(model_type_or_object, **kwargs)
         obj = None
         if isinstance(model_type_or_object, Model):
             # 是Model的字类的实例
@@ -287,13 +882,47 @@ class MySQLManager(SQLManager):
             obj.__setattr__(k, v)
         await obj.save_change(self)
 
+    async def upsert(self, model_type_or_object, update_fields=None, **kwargs):
+        """
+        写入一个条目, 如果主键已经存在就更新它. 只需要一次往返
+        :param model_type_or_object: Model 的子类实例(kwargs 会先设置到对象上)或者是 Model 的子类
+        :param update_fields: 主键存在的时候需要更新的属性. 默认为 Model 实例的所有属性或者 kwargs 中的非主键属性
+        :param kwargs: 主键以及其他的属性
+        :return: 受影响的行数. 写入为 1, 更新为 2, 没有修改为 0
+        """
+        await self.ensureConnected()
+        if isinstance(model_type_or_object, Model):
+            obj = model_type_or_object
+            for k, v in kwargs.items():
+                obj.__setattr__(k, v)
+        elif isinstance(model_type_or_object, ModelMetaclass):
+            obj = model_type_or_object(**kwargs)
+            if update_fields is None:
+                update_fields = [k for k in model_type_or_object.__fields__ if k in kwargs]
+        else:
+            raise ValueError(str(model_type_or_object) + '不是 "Model"的一个子类。')
+        return await obj.upsert(self, update_fields=update_fields)
+
+    async def upsert_many(self, model_type, objs, **kwargs):
+        """
+        批量写入或者更新条目
+        :param model_type: Model 的子类
+        :param objs: Model 的实例或者 dict 构成的可迭代对象
+        :param kwargs: update_fields, batch_rows, batch_bytes. 参考 Model.upsert_many
+        :return: 每一批受影响的行数
+        """
+        await self.ensureConnected()
+        if not isinstance(model_type, ModelMetaclass):
+            raise ValueError(str(model_type) + '不是 "Model"的一个子类。')
+        return await model_type.upsert_many(self, objs, **kwargs)
+
     async def queryAll(self, model_type, sql_where=None, args=None, **kwargs):
         """
         自定义查询, 正对一个已经存在的基本表、视图和临时表对象进行查询
         :param model_type: ORM元类的子类
         :param sql_where: SQL语句，使用?占位
         :param args: 占位符的实际值
-        :param kwargs: 其他参数，orderBy 表示排序;limit 表示限制的结果过数量； toDict: 针对临时表。返回的结果是否保存为唯一的主键映射->其他的属性，默认关闭。注意需要在 ORM 中指定唯一的主键。注意，如果使用了排序那么无效。
+        :param kwargs: 其他参数，orderBy 表示排序;limit 表示限制的结果过数量； toDict: 针对临时表。返回的结果是否保存为唯一的主键映射->其他的属性，默认关闭。注意需要在 ORM 中指定唯一的主键。注意，如果使用了排序那么无效。compact: 返回元类生成的紧凑行对象(__slots__)而不是基于 dict 的模型对象，默认使用模型的 __compact__。as_columns: 返回 dict, 每一列是一个 numpy 数组(需要安装 numpy)，不创建每一行的对象。
         :return:
         """
         await self.ensureConnected()
@@ -302,18 +931,105 @@ class MySQLManager(SQLManager):
         obj = await model_type.query_all(self, where=sql_where, args=args, **kwargs)
         return obj
 
-    async def countNum(self, model_type, sql_where=None, args=None):
+    async def iterAll(self, model_type, sql_where=None, args=None, **kwargs):
+        """
+        流式地遍历查询的结果, 内存占用与 batch_size 有关, 而与结果的数量无关
+        :param model_type: ORM元类的子类
+        :param sql_where: SQL语句，使用?占位
+        :param args: 占位符的实际值
+        :param kwargs: batch_size 表示每次读取的行数; keyset 表示按照主键分页读取; 以及 orderBy, limit, compact. 参考 BasicModel.iter_all
+        :return: 异步生成器
+        """
+        await self.ensureConnected()
+        async for obj in model_type.iter_all(self, where=sql_where, args=args, **kwargs):
+            yield obj
+
+    async def queryPage(self, model_type, sql_where=None, args=None, after=None, size=100, **kwargs):
+        """
+        按照主键分页(keyset pagination), 深度的分页不会变慢
+        :param model_type: ORM元类的子类, 必须有主键
+        :param sql_where: SQL语句，使用?占位
+        :param args: 占位符的实际值
+        :param after: 上一页返回的主键的值, None 表示第一页
+        :param size: 每一页的数量
+        :return: (对象的列表, 下一页使用的 after 或者 None)
+        """
+        await self.ensureConnected()
+        return await model_type.query_page(self, where=sql_where, args=args, after=after, size=size, **kwargs)
+
+    async def countNum(self, model_type, sql_where=None, args=None, **kwargs):
         """
         count the number of records specified by primary keys
         :param model_type: Model type. not the instance of the model
         :param obj_primaryKeys: primary keys
+        :param kwargs: approximate: use the estimate of MySQL instead of COUNT(*)
         :return: number
         """
         await self.ensureConnected()
         # if not isinstance(model_type, BasicModel):
         #     raise ValueError(str(model_type) + '不是 "BasicModel"的一个子类。')
-        num = await model_type.query_count(self, where=sql_where, args=args)
+        num = await model_type.query_count(self, where=sql_where, args=args, **kwargs)
         return num
 
+    async def createTable(self, model_type, if_not_exists=True):
+        """
+        根据 __mappings__ 和 __indexes__ 创建表
+        :param model_type: Model 的子类
+        :param if_not_exists: 表已经存在的时候不做任何操作
+        :return:
+        """
+        await self.ensureConnected()
+        await model_type.create_table(self, if_not_exists=if_not_exists)
+
+    async def loadReplicated(self, models, refresh_interval=None):
+        """
+        把声明了 __replicated__ 的表加载到内存中, 等值条件的查询不再访问 MySQL
+        :param models: Model 或者 ViewTable 的子类的列表
+        :param refresh_interval: 秒, 定期重新加载. None 表示只在通过 ORM 写入之后重新加载, 没有声明 __base_tables__ 的视图必须设置
+        :return: dict, 模型 -> 行数
+        """
+        await self.ensureConnected()
+        result = dict()
+        for model_type in models:
+            result[model_type] = await model_type.load_replica(self, refresh_interval=refresh_interval)
+            self._replicated.add(model_type)
+        return result
+
+    async def checkIndexes(self, models, sync=False):
+        """
+        检查模型声明的索引是否存在, 不存在的索引会输出警告
+        :param models: Model 的子类的列表
+        :param sync: 创建不存在的索引
+        :return: dict, 模型 -> 不存在(或者新创建)的 Index 的列表
+        """
+        await self.ensureConnected()
+        result = dict()
+        for model_type in models:
+            if sync:
+                result[model_type] = await model_type.sync_indexes(self)
+            else:
+                result[model_type] = await model_type.check_indexes(self)
+        return result
+
+    def objects(self, model_type):
+        """
+        使用这个管理器的延迟执行的查询, 等价于 model_type.objects.using(self)
+        :param model_type: ORM元类的子类
+        :return: QuerySet
+        """
+        return model_type.objects.using(self)
+
+    async def aggregate(self, model_type, sql_where=None, args=None, **kwargs):
+        """
+        在 MySQL 中计算聚合函数, 参考 BasicModel.aggregate
+        :param model_type: ORM元类的子类
+        :param sql_where: SQL语句，使用?占位
+        :param args: 占位符的实际值
+        :param kwargs: group_by, having, having_args, orderBy, limit 以及 结果的名字=Aggregate 的实例
+        :return: namedtuple 的列表; 没有 group_by 的时候是一个 namedtuple
+        """
+        await self.ensureConnected()
+        return await model_type.aggregate(self, where=sql_where, args=args, **kwargs)
+
 
 
@@ -0,0 +1,92 @@
+# coding=utf-8
+__author__ = 'Shu Wang <wangshu214@live.cn>'
+__version__ = '0.0.0.1'
+__all__ = ['PrimaryKeyLoader']
+__doc__ = 'Appointed2 - batch the primary key lookups made in the same tick of the event loop'
+from asyncio import shield
+from ap_logger.logger import make_logger
+
+
+_loader_logger = make_logger('LOADER')
+
+
+class PrimaryKeyLoader(object):
+
+    """
+    类似 DataLoader: 收集在事件循环的同一轮中请求的主键, 然后使用一条 where pk in (...) 的查询读取,
+    再把结果分别交给每一个调用者. 每一个调用者得到的都是单独的对象.
+    读取固定在主库(pin_primary, read_your_writes)的调用者与其他的调用者分开查询
+    """
+
+    def __init__(self, dbm, model_type, max_batch_size=500):
+        """
+        create a loader
+        :param dbm: SQLManager's instance
+        :param model_type: subclass of Model
+        :param max_batch_size: maximum keys in one query
+        """
+        self.dbm = dbm
+        self.model_type = model_type
+        self.max_batch_size = max_batch_size
+        self._pending = dict()  # (是否读取主库, key) -> list of futures
+        self._scheduled = False
+        self.loads = 0  # 调用 load 的次数
+        self.queries = 0  # 实际执行的查询的次数
+
+    def load(self, **primary_keys):
+        """
+        request an object by primary keys
+        :param primary_keys:
+        :return: awaitable, the result is the object or None
+        """
+        model_type = self.model_type
+        if len(primary_keys) < len(model_type.__primary_keys__):
+            raise RuntimeError("Not enough primary key(s) specified")
+        key = tuple(primary_keys.get(k) for k in model_type.__primary_keys__)
+        loop = self.dbm.loop
+        future = loop.create_future()
+        self._pending.setdefault((bool(getattr(self.dbm, 'primary_pinned', False)), key), []).append(future)
+        self.loads += 1
+        if not self._scheduled:
+            self._scheduled = True
+            loop.call_soon(self._dispatch)
+        return shield(future)  # 一个调用者被取消不会影响查询
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, dict()
+        self._scheduled = False
+        for pinned in (False, True):
+            keys = [key for p, key in pending.keys() if p is pinned]
+            for i in range(0, len(keys), self.max_batch_size):
+                batch = {key: pending[(pinned, key)] for key in keys[i:i + self.max_batch_size]}
+                self.dbm.loop.create_task(self._fetch(batch, pinned))
+
+    async def _fetch(self, batch, pinned=False):
+        self.queries += 1
+        if hasattr(self.dbm, 'pin_primary'):
+            self.dbm.pin_primary(pinned)  # 任务复制了第一个调用者的上下文, 使用这一批调用者自己的设置
+        try:
+            objs = await self.model_type.query_many_with_primary_keys(self.dbm, batch.keys())
+        except BaseException as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        _loader_logger.debug('Load %d key(s) of %s, found %d' % (len(batch), self.model_type.__name__, len(objs)))
+        for key, futures in batch.items():
+            obj = objs.get(key)
+            for future in futures:
+                if not future.done():
+                    future.set_result(obj)
+                    if obj is not None:
+                        obj = self.model_type._hydrate([dict(obj)], False)[0]  # 重复的主键得到一个新的对象
+
+    def stats(self):
+        """
+        counters of this loader
+        :return: dict
+        """
+        return {'loads': self.loads, 'queries': self.queries}
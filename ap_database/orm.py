@@ -6,9 +6,9 @@
 # ref03：https://github.com/wl356485255/pythonORM/blob/master/ormTest.py
 __author__ = 'Shu Wang <wangshu214@live.cn>'
 __version__ = '0.0.0.1'
-__all__ = ['create_args_string',
+__all__ = ['create_args_string', 'make_row_class', 'make_cache', 'make_replica', 'invalidate_replicas', 'upsert_suffix', 'Index', 'ForeignKey', 'OneToMany', 'Aggregate', 'Sum', 'Avg', 'Min', 'Max', 'Count', 'CompiledSQL', 'compile_sql', 'translate_placeholders', 'statement_cache', 'invalidate_counts', 'count_generation',
            'Field', 'StringField', 'BooleanField', 'IntegerField', 'FloatField', 'TextField', 'SmallIntField', 'DateTimeField',
-           'BasicModel',
+           'BasicModel', 'BasicRow',
            'ModelMetaclass', 'Model','TempModel', 'TempModelMetaclass',
            'ViewTable', 'ViewTableMetaclass']
 __doc__ = 'Appointed2 - ORM define'
@@ -16,6 +16,12 @@ __doc__ = 'Appointed2 - ORM define'
 
 
 from ap_logger.logger import make_logger
+from ap_database.cache import LRUCache, TTLCache
+from ap_database.queryset import QuerySetDescriptor
+from ap_database.replicated import ReplicatedTable
+from keyword import iskeyword
+from collections import namedtuple
+from abc import ABCMeta, abstractmethod
 
 
 _logger = make_logger('SQL')
@@ -41,8 +47,44 @@ def create_args_string(num):
     return ','.join(L)
 
 
+class CompiledSQL(str):
+
+    """
+    占位符已经转换为驱动使用的 %s 的 SQL 语句, 执行的时候不再需要转换
+    """
+    __slots__ = ()
+
+
+def compile_sql(sql):
+    """
+    translate the placeholders ? into %s once
+    :param sql: sql, placeholder is ?
+    :return: CompiledSQL
+    """
+    if isinstance(sql, CompiledSQL):
+        return sql
+    return CompiledSQL(sql.replace('?', '%s'))
+
+
+def translate_placeholders(sql):
+    """
+    get the sql used by the driver
+    :param sql: CompiledSQL or sql whose placeholder is ?
+    :return: sql string
+    """
+    if isinstance(sql, CompiledSQL):
+        return sql
+    return sql.replace('?', '%s')
+
+
+# 查询语句的缓存. 键为 (模型, 语句的头部, where, groupBy, having, orderBy, limit 的形式), 值为 CompiledSQL
+statement_cache = LRUCache(maxsize=512)
+
+
 # 定义Field类，负责保存(数据库)表的字段名和字段类型
 class Field(object):
+    dtype = 'object'  # 列式查询结果中 numpy 数组的类型
+
     # 表的字段的 表名前缀、名字、类型、是否为主键、默认值
     def __init__(self, prefix, name, column_type, primary_key, default):
         self.prefix = '' if not prefix else (prefix + '.')  # 我加上 . 作为处理
@@ -66,6 +108,8 @@ class StringField(Field):
 
 
 class BooleanField(Field):
+    dtype = 'bool'
+
     def __init__(self, prefix=None, name=None, default=None):
         super().__init__(prefix, name, 'boolean', False, default)
 
@@ -74,6 +118,8 @@ class BooleanField(Field):
 
 
 class IntegerField(Field):
+    dtype = 'int64'
+
     def __init__(self, prefix=None, name=None, primary_key=False, default=None):
         super().__init__(prefix, name, 'bigint', primary_key, default)
 
@@ -82,6 +128,8 @@ class IntegerField(Field):
 
 
 class SmallIntField(Field):
+    dtype = 'int16'
+
     def __init__(self, prefix=None, name=None, primary_key=False, default=None):
         super().__init__(prefix, name, 'smallint', primary_key, default)
 
@@ -90,6 +138,8 @@ class SmallIntField(Field):
 
 
 class FloatField(Field):
+    dtype = 'float64'
+
     def __init__(self, prefix=None, name=None, primary_key=False, default=None):
         super().__init__(prefix, name, 'real', primary_key, default)
 
@@ -107,6 +157,8 @@ class TextField(Field):
 
 class DateTimeField(Field):
 
+    dtype = 'datetime64[us]'
+
     def __init__(self, prefix=None, name=None, primary_key=False, default=None):
         super(DateTimeField, self).__init__(prefix, name, 'datetime', primary_key, default)
 
@@ -114,6 +166,472 @@ class DateTimeField(Field):
         return 'DateTimeField'
 
 
+def make_cache(config):
+    """
+    create the cache of a model from the value of __cache__ or __count_cache__
+    :param config: None or False means no cache; True means the default TTLCache; a dict is passed to TTLCache;
+    otherwise it must be an object which has the methods get, set, invalidate, clear and stats like LRUCache
+    :return: cache or None
+    """
+    if config is None or config is False:
+        return None
+    if config is True:
+        return TTLCache()
+    if isinstance(config, dict):
+        return TTLCache(**config)
+    for method in ('get', 'set', 'invalidate', 'clear', 'stats'):
+        if not callable(getattr(config, method, None)):
+            raise ValueError('Cache object must have the method: %s' % method)
+    return config
+
+
+# 表名 -> 使用这个表的模型的计数缓存
+_count_caches = dict()
+# 表名 -> 计数缓存被清空的次数, 清空之前开始的计数不再写入缓存, 参考 query_count
+_count_generations = dict()
+
+
+def register_count_cache(tables, cache):
+    """
+    register the count cache of a model, it will be cleared when the tables are written through the ORM
+    :param tables: names of the tables used by the model
+    :param cache: cache or None
+    :return: cache
+    """
+    if cache is not None:
+        for table in tables:
+            _count_caches.setdefault(table, []).append(cache)
+    return cache
+
+
+def invalidate_counts(table):
+    """
+    clear the cached counts of the models using the table. call it after writing the table with raw sql
+    :param table: name of the table
+    :return:
+    """
+    _count_generations[table] = _count_generations.get(table, 0) + 1
+    for cache in _count_caches.get(table, ()):
+        cache.clear()
+
+
+def count_generation(tables):
+    """
+    how many times the count caches of the tables were cleared
+    :param tables: names of the tables
+    :return: tuple, compare it before and after counting
+    """
+    return tuple(_count_generations.get(table, 0) for table in tables)
+
+
+def upsert_suffix(fields):
+    """
+    create the 'on duplicate key update' clause for the fields
+    :param fields: names of the fields to update when the primary key exists
+    :return: sql clause
+    """
+    return ' on duplicate key update %s' % ', '.join(map(lambda f: '`%s`=values(`%s`)' % (f, f), fields))
+
+
+class Aggregate(object):
+
+    """
+    聚合函数, 用于 BasicModel.aggregate. 例如 total=Sum('amount'), users=Count('user_id', distinct=True)
+    """
+    function = None
+
+    def __init__(self, field, distinct=False):
+        """
+        create an aggregate
+        :param field: name of the field or column. '*' is only allowed by Count
+        :param distinct: aggregate the distinct values
+        """
+        if field == '*' and (self.function != 'COUNT' or distinct):
+            raise ValueError('Invalid field for %s: *' % self.function)
+        self.field = field
+        self.distinct = distinct
+
+    def sql(self, model):
+        """
+        the expression in select clause
+        :param model: the model class
+        :return: sql
+        """
+        expr = '*' if self.field == '*' else model._column_expr(self.field)
+        return '%s(%s%s)' % (self.function, 'DISTINCT ' if self.distinct else '', expr)
+
+    def __repr__(self):
+        return '%s(%r%s)' % (self.__class__.__name__, self.field, ', distinct=True' if self.distinct else '')
+
+
+class Sum(Aggregate):
+    function = 'SUM'
+
+
+class Avg(Aggregate):
+    function = 'AVG'
+
+
+class Min(Aggregate):
+    function = 'MIN'
+
+
+class Max(Aggregate):
+    function = 'MAX'
+
+
+class Count(Aggregate):
+    function = 'COUNT'
+
+    def __init__(self, field='*', distinct=False):
+        super(Count, self).__init__(field, distinct)
+
+
+class Index(object):
+
+    """
+    表的二级索引, 在模型中通过 __indexes__ 声明, 例如 __indexes__ = [Index('email', unique=True), Index('state', 'created_time')]
+    """
+
+    def __init__(self, *fields, unique=False, name=None):
+        """
+        declare an index
+        :param fields: names of the fields in the order of the index
+        :param unique: unique index
+        :param name: name of the index, default is generated from the columns
+        """
+        if not fields:
+            raise ValueError('No field specified for the index')
+        self.fields = fields
+        self.unique = unique
+        self.name = name
+        self.columns = ()  # 元类根据 __mappings__ 设置
+
+    def bind(self, model_name, mappings):
+        """
+        resolve the columns of the fields, called by the metaclass
+        :param model_name: name of the model
+        :param mappings: __mappings__ of the model
+        :return: self
+        """
+        columns = []
+        for f in self.fields:
+            field = mappings.get(f)
+            if field is None:
+                raise ValueError('Index field "%s" is not a field of %s' % (f, model_name))
+            columns.append(field.name or f)
+        self.columns = tuple(columns)
+        if not self.name:
+            self.name = '%s_%s' % ('uq' if self.unique else 'idx', '_'.join(self.columns))
+        return self
+
+    def sql(self):
+        """
+        the definition in create table or alter table
+        :return: sql
+        """
+        return '%s `%s` (%s)' % ('unique key' if self.unique else 'key', self.name, ', '.join('`%s`' % c for c in self.columns))
+
+    def covered_by(self, columns, unique):
+        """
+        check whether an existing index can be used instead of this one
+        :param columns: columns of the existing index
+        :param unique: the existing index is unique
+        :return: bool
+        """
+        if self.unique:
+            return unique and tuple(columns) == self.columns
+        return tuple(columns[:len(self.columns)]) == self.columns
+
+    def __repr__(self):
+        return 'Index(%s%s)' % (', '.join(map(repr, self.fields)), ', unique=True' if self.unique else '')
+
+
+# 表名 -> 读取这个表的模型的内存副本
+_replicas = dict()
+
+
+def make_replica(model, config, tables=()):
+    """
+    create the in-memory replica of a model from the value of __replicated__
+    :param model: the model class
+    :param config: None or False means not replicated; True means only the primary keys are indexed;
+    otherwise the names of the fields (or tuples of names) to build hash indexes on
+    :param tables: names of the tables read by the model, the replica is reloaded after they are written through the ORM
+    :return: ReplicatedTable or None
+    """
+    if config is None or config is False:
+        return None
+    replica = ReplicatedTable(model, () if config is True else config)
+    replica.tables = tuple(tables)
+    for table in replica.tables:
+        _replicas.setdefault(table, []).append(replica)
+    return replica
+
+
+def invalidate_replicas(table):
+    """
+    mark the replicas of the models reading the table stale and reload them. call it after writing the table with raw sql
+    :param table: name of the table
+    :return:
+    """
+    for replica in _replicas.get(table, ()):
+        replica.invalidate()
+
+
+# 模块.类名 -> 模型, 用于解析关系中使用字符串指定的模型. 不同模块中的同名模型不会互相覆盖
+_model_registry = dict()
+
+
+def _resolve_model(name, module=None):
+    """
+    find a model by the name used in a relation
+    :param name: 'module.ClassName' or 'ClassName'
+    :param module: module of the model declaring the relation, its models are preferred
+    :return: model class
+    """
+    model = _model_registry.get(name)
+    if model is None and module is not None:
+        model = _model_registry.get('%s.%s' % (module, name))
+    if model is None:
+        candidates = [m for k, m in _model_registry.items() if k.endswith('.' + name)]
+        if len(candidates) > 1:
+            raise ValueError('Ambiguous model name "%s", please use one of: %s' % (
+                name, ', '.join('%s.%s' % (m.__module__, m.__qualname__) for m in candidates)))
+        model = candidates[0] if candidates else None
+    return model
+
+# 预读取关系的时候 in (...) 中最多的值
+PREFETCH_BATCH_SIZE = 1000
+
+
+class Relation(object, metaclass=ABCMeta):
+
+    """
+    模型之间的关系. 在 Model 中声明为类属性, 元类把它们保存到 __relations__ 中. 通过 query_all(..., prefetch=[...]) 或者 fetch_related 读取,
+    每一个关系只需要 in (...) 的一条查询
+    """
+
+    def __init__(self, model, field, key=None):
+        """
+        declare a relation
+        :param model: the related model or its class name
+        :param field: see ForeignKey and OneToMany
+        :param key: see ForeignKey and OneToMany
+        """
+        self._model = model
+        self.field = field
+        self.key = key
+        self.name = None
+        self.module = None  # 声明这个关系的模型所在的模块
+
+    @property
+    def model(self):
+        """
+        the related model, resolved by name on first use
+        :return: model class
+        """
+        if isinstance(self._model, str):
+            model = _resolve_model(self._model, self.module)
+            if model is None:
+                raise ValueError('Unknown model in relation "%s": %s' % (self.name, self._model))
+            self._model = model
+        return self._model
+
+    def bind(self, name, model_name, mappings, primary_keys, module=None):
+        """
+        check the local field, called by the metaclass
+        :param name: name of the relation
+        :param model_name: name of the model declaring it
+        :param mappings: __mappings__ of the model
+        :param primary_keys: __primary_keys__ of the model
+        :param module: module of the model declaring it
+        :return: self
+        """
+        self.name = name
+        self.module = module
+        return self
+
+    @abstractmethod
+    def _local_and_remote(self):
+        """
+        :return: (field of the parent objects, field of the related model)
+        """
+
+    @abstractmethod
+    def _attach(self, objs, related):
+        """
+        store the related objects into the parent objects
+        :param objs: parent objects
+        :param related: related objects
+        :return:
+        """
+
+    async def prefetch(self, dbm, objs):
+        """
+        load the related objects of objs with in (...) and attach them as objs[name]
+        :param dbm:
+        :param objs: parent objects
+        :return:
+        """
+        local, remote = self._local_and_remote()
+        values = list(dict.fromkeys(v for v in (obj.get(local) for obj in objs) if v is not None))
+        related = []
+        model = self.model
+        expr = model._column_expr(remote)
+        for i in range(0, len(values), PREFETCH_BATCH_SIZE):
+            batch = values[i:i + PREFETCH_BATCH_SIZE]
+            related.extend(await model.query_all(dbm, '%s in (%s)' % (expr, create_args_string(len(batch))), batch, compact=False))  # _attach 需要模型对象
+        self._attach(objs, related)
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, getattr(self._model, '__name__', self._model), self.field)
+
+
+class ForeignKey(Relation):
+
+    """
+    多对一: 对象的 field 保存另一个模型的 key(默认是它唯一的主键). 预读取之后 obj.name 是相关的对象或者 None.
+    例如 author = ForeignKey('User', 'author_id')
+    """
+
+    def __init__(self, model, field, to_field=None):
+        """
+        declare a foreign key
+        :param model: the referenced model or its class name
+        :param field: the local field which holds the key
+        :param to_field: the referenced field, default is the primary key of the referenced model
+        """
+        super(ForeignKey, self).__init__(model, field, to_field)
+
+    def bind(self, name, model_name, mappings, primary_keys, module=None):
+        if self.field not in mappings:
+            raise ValueError('Relation field "%s" is not a field of %s' % (self.field, model_name))
+        return super(ForeignKey, self).bind(name, model_name, mappings, primary_keys, module)
+
+    def _local_and_remote(self):
+        to_field = self.key
+        if to_field is None:
+            primary_keys = getattr(self.model, '__primary_keys__', ())
+            if len(primary_keys) != 1:
+                raise ValueError('Please specify to_field of relation "%s", %s has no single primary key' % (self.name, self.model.__name__))
+            to_field = primary_keys[0]
+        return self.field, to_field
+
+    def _attach(self, objs, related):
+        _, to_field = self._local_and_remote()
+        by_key = {r.get(to_field): r for r in related}
+        for obj in objs:
+            dict.__setitem__(obj, self.name, by_key.get(obj.get(self.field)))  # 不是修改, 不记录到 _changed
+
+
+class OneToMany(Relation):
+
+    """
+    一对多: 另一个模型的 field 保存这个对象的 key(默认是唯一的主键). 预读取之后 obj.name 是相关的对象的列表.
+    例如 posts = OneToMany('Post', 'author_id')
+    """
+
+    def __init__(self, model, field, from_field=None):
+        """
+        declare a one-to-many relation
+        :param model: the related model or its class name
+        :param field: the field of the related model which holds the key
+        :param from_field: the local field referenced, default is the primary key
+        """
+        super(OneToMany, self).__init__(model, field, from_field)
+
+    def bind(self, name, model_name, mappings, primary_keys, module=None):
+        if self.key is None:
+            if len(primary_keys) != 1:
+                raise ValueError('Please specify from_field of relation "%s", %s has no single primary key' % (name, model_name))
+            self.key = primary_keys[0]
+        elif self.key not in mappings:
+            raise ValueError('Relation field "%s" is not a field of %s' % (self.key, model_name))
+        return super(OneToMany, self).bind(name, model_name, mappings, primary_keys, module)
+
+    def _local_and_remote(self):
+        return self.key, self.field
+
+    def _attach(self, objs, related):
+        groups = dict()
+        for r in related:
+            groups.setdefault(r.get(self.field), []).append(r)
+        for obj in objs:
+            dict.__setitem__(obj, self.name, groups.get(obj.get(self.key), []))
+
+
+# 聚合结果的 namedtuple 类型, 以列名为键
+_aggregate_types = dict()
+
+
+def _aggregate_type(names):
+    names = tuple(names)
+    result_type = _aggregate_types.get(names)
+    if result_type is None:
+        result_type = namedtuple('AggregateResult', names, rename=True)
+        _aggregate_types[names] = result_type
+    return result_type
+
+
+class BasicRow(object):
+
+    """
+    紧凑的行对象. 由元类根据 __mappings__ 生成 __slots__, 不再为每一行创建 dict, 属性直接访问.
+    行对象只用于读取, 需要修改和保存的时候调用 to_model 转换为对应的模型对象
+    """
+    __slots__ = ()
+    __model__ = None
+
+    def to_dict(self):
+        """
+        convert this row into a dict whose keys are the column names. used by the JSON response
+        :return: dict
+        """
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def to_model(self):
+        """
+        convert this row into an instance of the model which generated it
+        :return: model object
+        """
+        return self.__model__(**self.to_dict())
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (k, getattr(self, k)) for k in self.__slots__))
+
+
+def make_row_class(model, columns):
+    """
+    generate a compact row class for the model. __init__ and to_dict are compiled for the columns like namedtuple
+    :param model: the model class
+    :param columns: column names in the order of select
+    :return: the row class or None if the column names are not valid identifiers
+    """
+    if not columns or len(set(columns)) != len(columns):
+        return None
+    for c in columns:
+        if not c.isidentifier() or iskeyword(c):
+            return None
+    source = 'def __init__(self, %s):\n%s\n' \
+             'def to_dict(self):\n    return {%s}\n' % (
+        ', '.join('%s=None' % c for c in columns),
+        '\n'.join('    self.%s = %s' % (c, c) for c in columns),
+        ', '.join("'%s': self.%s" % (c, c) for c in columns))
+    namespace = dict()
+    exec(source, namespace)
+    return type('%sRow' % model.__name__, (BasicRow, ), {
+        '__slots__': tuple(columns),
+        '__model__': model,
+        '__module__': model.__module__,
+        '__init__': namespace['__init__'],
+        'to_dict': namespace['to_dict']
+    })
+
+
 # -*-定义Model的元类
 
 # 所有的元类都继承自type
@@ -159,6 +677,11 @@ class ModelMetaclass(type):
             raise ValueError('No primary key')
         for k in mappings.keys():  # 把所有属性相同的属性去掉
             attrs.pop(k)
+        # 关系同样从类属性中删除, 预读取的对象保存在 dict 中
+        relations = {k: v for k, v in attrs.items() if isinstance(v, Relation)}
+        for k in relations.keys():
+            attrs.pop(k)
+        attrs['__relations__'] = {k: v.bind(k, name, mappings, primaryKeys, attrs.get('__module__')) for k, v in relations.items()}
         escaped_fields = list(map(lambda f: '`%s`' % f, fields))
         # primary keys的生成。生成的是主建的fields串
         primaryKey_fields = list(map(lambda f: '`%s`' % f, primaryKeys))
@@ -174,11 +697,41 @@ class ModelMetaclass(type):
         attrs['__insert__'] = 'insert into  `%s` (%s %s) values(%s)' % (
         tableName,', '.join(escaped_fields) + ', ' if len(escaped_fields) > 0 else '', ', '.join(primaryKey_fields), create_args_string(len(escaped_fields) + len(primaryKey_fields)))
 
+        # 多行插入: 插入语句的头部以及每一行的占位符, 顺序与 __insert__ 相同
+        attrs['__insert_head__'] = 'insert into  `%s` (%s) values ' % (tableName, ', '.join(escaped_fields + primaryKey_fields))
+        attrs['__insert_row__'] = '(%s)' % create_args_string(len(escaped_fields) + len(primaryKey_fields))
+
+        # insert ... on duplicate key update, 默认更新所有的非主键属性. 没有非主键属性的时候不做任何修改
+        attrs['__upsert_cache__'] = dict()
+        attrs['__upsert__'] = attrs['__insert__'] + upsert_suffix(fields or primaryKeys[:1])
+
+        # 主键的读缓存, 写操作会自动失效对应的项
+        attrs['__cache__'] = make_cache(attrs.get('__cache__', None))
+        attrs['__cache_fills__'] = dict()  # 主键 -> [进行中的读取的数量, 失效的次数], 参考 _begin_cache_fill
+        attrs['__count_tables__'] = (tableName,)
+        attrs['__count_cache__'] = register_count_cache([tableName], make_cache(attrs.get('__count_cache__', None)))
+        attrs['__update_cache__'] = dict()  # 只更新修改过的属性的 update 语句, 以修改的属性为键
         attrs['__update__'] = 'update `%s` set %s where %s' % (
         tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKeys_and_fields)
 
+        # 声明的二级索引, 用于生成 DDL 以及检查表结构
+        attrs['__indexes__'] = tuple(index.bind(name, mappings) for index in attrs.get('__indexes__', ()))
         attrs['__delete__'] = 'delete from  `%s` where %s' % (tableName, primaryKeys_and_fields)
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__select_pk__'] = '%s where %s' % (attrs['__select__'], primaryKeys_and_fields)
+        # 保存驱动可以直接使用的语句
+        for key in ('__select__', '__select_pk__', '__insert__', '__insert_row__', '__upsert__', '__update__', '__delete__'):
+            attrs[key] = compile_sql(attrs[key])
+        # select 结果中的列名, 顺序与 __select__ 一致. 用于生成紧凑的行对象
+        attrs['__columns__'] = primaryKeys + fields
+        # 投影查询: 每一列在 select 中的表达式以及 from 子句
+        attrs['__column_sql__'] = primaryKey_fields + escaped_fields
+        attrs['__from__'] = '`%s`' % tableName
+        attrs['__projections__'] = dict()
+        new_cls = type.__new__(cls, name, bases, attrs)
+        new_cls.__row__ = make_row_class(new_cls, new_cls.__columns__)
+        new_cls.__replica__ = make_replica(new_cls, attrs.get('__replicated__', None), [tableName])
+        _model_registry['%s.%s' % (new_cls.__module__, new_cls.__qualname__)] = new_cls
+        return new_cls
 
 
 class TempModelMetaclass(type):
@@ -225,8 +778,23 @@ class TempModelMetaclass(type):
         # select 子句: 注意 letName.`field` https://stackoverflow.com/questions/29451086/pymysql-syntax-when-using-two-tables
         attrs['__select__'] = 'select {s} from {t} '.format(s=','.join(['{prefix}`{fieldName}`'.format(prefix=field.prefix, fieldName=field.name if field.name else fn) for fn, field in mappings.items()]),  # 临时表可能存在属性不一致的情况
                                                             t=attrs['__tables__'])
+        attrs['__select__'] = compile_sql(attrs['__select__'])
         attrs['__primaryKey__'] = primaryKey
-        return type.__new__(cls, name, bases, attrs)
+        # 结果中的列名已经去掉了表的前缀. 与 pymysql 的 DictCursor 一致, 重复的列名使用 别名.列名, 例如 u.id 和 o.id 得到 id 和 o.id
+        labels = dict()
+        for fn, field in mappings.items():
+            label = field.name if field.name else fn
+            labels[fn] = label if label not in labels.values() else field.prefix + label
+        attrs['__labels__'] = labels
+        attrs['__columns__'] = list(labels.values())
+        attrs['__column_sql__'] = ['{prefix}`{fieldName}`'.format(prefix=field.prefix, fieldName=field.name if field.name else fn) for fn, field in mappings.items()]
+        attrs['__from__'] = attrs['__tables__']
+        attrs['__count_tables__'] = tuple(tables.keys())
+        attrs['__count_cache__'] = register_count_cache(attrs['__count_tables__'], make_cache(attrs.get('__count_cache__', None)))
+        attrs['__projections__'] = dict()
+        new_cls = type.__new__(cls, name, bases, attrs)
+        new_cls.__row__ = make_row_class(new_cls, new_cls.__columns__)
+        return new_cls
 
 
 class ViewTableMetaclass(type):
@@ -272,9 +840,20 @@ class ViewTableMetaclass(type):
 
         attrs['__fields__'] = fields
 
-        attrs['__select__'] = 'select %s from `%s`' % (', '.join(string_fields) if len(string_fields) > 0 else '*', tableName)
-
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__select__'] = compile_sql('select %s from `%s`' % (', '.join(string_fields) if len(string_fields) > 0 else '*', tableName))
+        attrs['__columns__'] = fields  # select * 的时候列是未知的, 不能生成行对象
+        attrs['__column_sql__'] = string_fields
+        attrs['__from__'] = '`%s`' % tableName
+        # 视图读取的表, 通过 ORM 写入它们之后清空计数缓存并重新加载内存副本
+        base_tables = list(attrs.get('__base_tables__', ()))
+        attrs['__base_tables__'] = base_tables
+        attrs['__count_tables__'] = tuple([tableName] + base_tables)
+        attrs['__count_cache__'] = register_count_cache(attrs['__count_tables__'], make_cache(attrs.get('__count_cache__', None)))
+        attrs['__projections__'] = dict()
+        new_cls = type.__new__(cls, name, bases, attrs)
+        new_cls.__row__ = make_row_class(new_cls, new_cls.__columns__)
+        new_cls.__replica__ = make_replica(new_cls, attrs.get('__replicated__', None), base_tables)
+        return new_cls
 
 
 # 定义ORM所有映射的基类：Model
@@ -288,6 +867,18 @@ class BasicModel(dict):
     """
     定义基本的模型, 这个是所有临时表 视图 基本表拥有的操作
     """
+    __row__ = None  # 元类生成的紧凑行对象的类
+    __cache__ = None  # 主键查询的缓存, 参考 make_cache
+    __count_cache__ = None  # query_count 的缓存, 通过 ORM 写入表的时候清空
+    __count_tables__ = ()  # 写入之后需要清空计数缓存的表
+    __compact__ = False  # 查询的结果默认是否使用紧凑的行对象
+    __cursor__ = 'dict'  # 查询默认使用的游标. tuple 表示使用元组游标, 按照 __columns__ 直接构建对象
+    _deferred = ()  # 投影查询中没有读取的列
+    _deferred_group = None  # 同一次查询得到的对象, 延迟的列一起读取
+    __replica__ = None  # 复制到内存中的表, 参考 make_replica
+    __relations__ = dict()  # 关系的名字 -> Relation, 参考 ForeignKey 和 OneToMany
+    __labels__ = None  # 临时表: 属性 -> 结果中的列名
+    objects = QuerySetDescriptor()  # 延迟执行的查询, 例如 User.objects.using(dbm).filter(state=1)[:10]
 
     def __init__(self, **kw):
         super(BasicModel, self).__init__(**kw)
@@ -296,6 +887,10 @@ class BasicModel(dict):
         try:
             return self[key]
         except KeyError:
+            if key in self._deferred:
+                raise AttributeError(r'"%s" is deferred, please call "await obj.load_deferred(dbm)" first' % key)
+            if key in self.__relations__:
+                raise AttributeError(r'Relation "%s" is not loaded, please use prefetch or call "await obj.fetch_related(dbm)" first' % key)
             raise AttributeError(r'"%s" objct has not attribute: %s' % (self.__class__.__name__, key))
 
     def __setattr__(self, key, value):
@@ -314,6 +909,246 @@ class BasicModel(dict):
             setattr(self, key, value)
         return value
 
+    def _value_or_default(self, key):
+        """
+        like getValueOrDefault, but only None is replaced by the default. the falsy values (0, False, '') are kept,
+        used by upsert whose update part takes the same values
+        :param key: name of the field
+        :return: value
+        """
+        value = getattr(self, key, None)
+        if value is None:
+            return self.getValueOrDefault(key)
+        return value
+
+    @classmethod
+    def _hydrate(cls, rs, compact=None, columns=None):
+        """
+        convert the result into model objects or compact rows
+        :param rs: list of dict (DictCursor), or list of tuples (Cursor) if columns is specified
+        :param compact: use the row class generated by metaclass. None means the value of __compact__
+        :param columns: names of the columns in the tuples
+        :return: list of objects
+        """
+        if compact is None:
+            compact = cls.__compact__
+        if compact:
+            row = cls.__row__
+            if row is None:
+                raise ValueError('Compact row is not available for "%s", please check the names of the columns' % cls.__name__)
+            if columns is None:
+                return [row(**r) for r in rs]
+            if columns is cls.__columns__:
+                return [row(*r) for r in rs]
+            return [row(**dict(zip(columns, r))) for r in rs]
+        if columns is None:
+            return [cls(**r) for r in rs]
+        # 元组直接写入新的对象, 没有中间的 dict. 与反序列化一样, 不调用 __init__
+        new, update = cls.__new__, dict.update
+        objs = []
+        for r in rs:
+            obj = new(cls)
+            update(obj, zip(columns, r))
+            objs.append(obj)
+        return objs
+
+    @classmethod
+    async def _query_columns(cls, dbm, sql, args, columns=None):
+        """
+        perform the select and return the result as numpy arrays. no object is created for the rows
+        :param dbm: dbm
+        :param sql: sql
+        :param args: arguments for placeholders
+        :param columns: names of the selected columns, None means __columns__
+        :return: dict, column name -> numpy array
+        """
+        if not cls.__columns__:
+            raise ValueError('Columnar result is not available for "%s" whose columns are unknown' % cls.__name__)
+        from ap_database.columnar import to_columns
+        rs = await dbm.inner_select(sql, args, cursor='tuple')
+        return to_columns(cls, rs, columns or cls.__columns__)
+
+    @classmethod
+    async def _select_rows(cls, dbm, sql, args, cursor=None, columns=None):
+        """
+        perform the select with the cursor configured by __cursor__
+        :param dbm: dbm
+        :param sql: sql
+        :param args: arguments for placeholders
+        :param cursor: 'dict' or 'tuple'. None means the value of __cursor__
+        :param columns: names of the selected columns, None means __columns__
+        :return: (rows, names of the columns if rows are tuples else None)
+        """
+        if (cursor or cls.__cursor__) == 'tuple' and cls.__columns__:
+            return await dbm.inner_select(sql, args, cursor='tuple'), columns or cls.__columns__
+        return await dbm.inner_select(sql, args), None
+
+    @classmethod
+    def _column_label(cls, name):
+        """
+        find the column in the result by the name of a field or column
+        :param name: name of the field or column
+        :return: column name in __columns__
+        """
+        columns = cls.__columns__
+        if name in columns:
+            return name
+        labels = cls.__labels__
+        if labels is not None and name in labels:
+            return labels[name]  # 临时表的属性名
+        field = cls.__mappings__.get(name)
+        if field is not None and field.name in columns:
+            return field.name
+        raise ValueError('"%s" is not a column of %s' % (name, cls.__name__))
+
+    @classmethod
+    def _column_expr(cls, name):
+        """
+        the expression of a field or column in sql
+        :param name: name of the field or column
+        :return: sql
+        """
+        return cls.__column_sql__[cls.__columns__.index(cls._column_label(name))]
+
+    @classmethod
+    def _projection(cls, only=None, defer=None):
+        """
+        select only some of the columns. the key columns (primary keys) are always selected
+        :param only: names of the fields or columns to select
+        :param defer: names of the fields or columns not to select
+        :return: (names of the selected columns, compiled select clause, names of the deferred columns)
+        """
+        key = (tuple(only or ()), tuple(defer or ()))
+        projection = cls.__projections__.get(key)
+        if projection is None:
+            columns = cls.__columns__
+            if not columns:
+                raise ValueError('Projection is not available for "%s" whose columns are unknown' % cls.__name__)
+            try:
+                required = set(label for _, label in cls._keyset_columns())
+            except NotImplementedError:
+                required = set()
+            wanted = set(map(cls._column_label, only)) | required if only else set(columns)
+            if defer:
+                wanted -= set(map(cls._column_label, defer)) - required
+            selected = [c for c in columns if c in wanted]
+            exprs = dict(zip(columns, cls.__column_sql__))
+            head = compile_sql('select %s from %s' % (', '.join(exprs[c] for c in selected), cls.__from__))
+            projection = (selected, head, tuple(c for c in columns if c not in wanted))
+            cls.__projections__[key] = projection
+        return projection
+
+    @classmethod
+    async def _query_projection(cls, dbm, where, args, kw):
+        """
+        perform the query_all with the keyword arguments only, defer, orderBy, limit, cursor, compact and as_columns
+        :return: (rows or arrays, names of the columns if rows are tuples else None)
+        """
+        only, defer = kw.get('only', None), kw.get('defer', None)
+        if only or defer:
+            columns, head, deferred = cls._projection(only, defer)
+        else:
+            columns, head, deferred = None, None, ()
+        sql, sql_args = cls._compile_query(where, args, kw.get('orderBy', None), kw.get('limit', None), head=head)
+        if kw.get('as_columns'):
+            return await cls._query_columns(dbm, sql, sql_args, columns), None
+        rs, columns = await cls._select_rows(dbm, sql, sql_args, kw.get('cursor'), columns)
+        objs = cls._hydrate(rs, kw.get('compact'), columns)
+        if deferred and objs and isinstance(objs[0], BasicModel):
+            group = (objs, where, list(args) if args else [])  # 读取延迟的列需要原来的查询条件
+            for obj in objs:
+                object.__setattr__(obj, '_deferred', deferred)
+                object.__setattr__(obj, '_deferred_group', group)
+        return objs, rs if columns is None else None
+
+    async def load_deferred(self, dbm, *fields):
+        """
+        load the deferred columns for all the objects returned by the same query, with one query
+        :param dbm: dbm
+        :param fields: names of the deferred fields or columns, default is all of them
+        :return:
+        """
+        if not self._deferred:
+            return
+        columns = self.__columns__
+        by_attr = self.__labels__ or {k: field.name or k for k, field in self.__mappings__.items()}
+        names = [f if f in columns else by_attr.get(f, f) for f in fields] or list(self._deferred)
+        objs, where, args = self._deferred_group
+        objs = [obj for obj in objs if any(n in obj._deferred for n in names)]
+        if not objs:
+            return
+        keys = self._keyset_columns()  # 视图没有主键, 不能读取延迟的列
+        key_args = []
+        for obj in objs:
+            key_args.extend(obj[label] for _, label in keys)
+        if len(keys) == 1:
+            cond = '%s in (%s)' % (keys[0][0], create_args_string(len(objs)))
+        else:
+            cond = ' or '.join(['(%s)' % ' and '.join('%s=?' % expr for expr, _ in keys)] * len(objs))
+        if where and not isinstance(self, Model):
+            cond = '(%s) and (%s)' % (where, cond)  # 连接的条件在 where 中
+            key_args = args + key_args
+        exprs = dict(zip(columns, self.__column_sql__))
+        selected = [label for _, label in keys] + [n for n in names if n not in dict(keys).values()]
+        sql = compile_sql('select %s from %s where %s' % (', '.join(exprs[c] for c in selected), self.__from__, cond))
+        rs = await dbm.inner_select(sql, key_args)
+        rows = {tuple(r[label] for _, label in keys): r for r in rs}
+        for obj in objs:
+            row = rows.get(tuple(obj[label] for _, label in keys), {})
+            for n in names:
+                if n in obj._deferred:
+                    dict.__setitem__(obj, n, row.get(n))  # 不是修改, 不记录到 _changed
+            object.__setattr__(obj, '_deferred', tuple(d for d in obj._deferred if d not in names))
+
+    @classmethod
+    def _compile_query(cls, where=None, args=None, orderBy=None, limit=None, head=None, groupBy=None, having=None):
+        """
+        get the compiled sql from the statement cache and arrange the arguments
+        :param where: where sql, the placeholder is ?
+        :param args: arguments for placeholders, the arguments of having follow the ones of where
+        :param orderBy: order by sql
+        :param limit: int or tuple of (offset, size)
+        :param head: select clause, default is __select__
+        :param groupBy: group by sql
+        :param having: having sql, the placeholder is ?
+        :return: (CompiledSQL, list of arguments)
+        """
+        if limit is None:
+            shape, limit_args = 0, ()
+        elif isinstance(limit, int):
+            shape, limit_args = 1, (limit, )
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            shape, limit_args = 2, limit
+        else:
+            raise ValueError('Invalid limit value: %s' % str(limit))
+        if head is None:
+            head = cls.__select__
+        key = (cls, head, where, groupBy, having, orderBy, shape)
+        sql = statement_cache.get(key)
+        if sql is None:
+            sql = [head]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            if groupBy:
+                sql.append('group by')
+                sql.append(groupBy)
+            if having:
+                sql.append('having')
+                sql.append(having)
+            if orderBy:
+                sql.append('order by')
+                sql.append(orderBy)
+            if shape == 1:
+                sql.append('limit ?')
+            elif shape == 2:
+                sql.append('limit ?,?')
+            sql = compile_sql(' '.join(sql))
+            statement_cache.set(key, sql)
+        args = list(args) if args else []
+        args.extend(limit_args)
+        return sql, args
+
     @classmethod
     # 类方法有类变量cls传入，从而可以用cls做一些相关的处理。并且有子类继承时，调用该类方法时，传入的类变量cls是子类，而非父类。
     async def query_all(cls, dbm, where=None, args=None, **kw):
@@ -322,55 +1157,270 @@ class BasicModel(dict):
         :param dbm: dbm
         :param where: where sql, the placeholder is ?
         :param args: arguments for placeholders
-        :param kw: orderBy: string; limit: int
+        :param kw: orderBy: string; limit: int; compact: return compact rows instead of model objects;
+        cursor: 'tuple' hydrates the objects from a tuple cursor; as_columns: return a dict of numpy arrays, one for each column;
+        only: names of the fields to select; defer: names of the fields not to select, see load_deferred.
+        the objects can not be inserted or upserted until the columns which are not selected are loaded;
+        prefetch: names of the relations to load, one query for each relation. it requires model objects
         :return: result
         """
-        sql = [cls.__select__]
+        if kw.get('prefetch') and (kw.get('as_columns') or (cls.__compact__ if kw.get('compact') is None else kw.get('compact'))):
+            raise ValueError('prefetch can not be used with as_columns or compact rows of %s, the related objects are stored in the model objects' % cls.__name__)
+        replica = cls.__replica__
+        rows = None
+        if replica is not None and not any(kw.get(k) for k in ('orderBy', 'limit', 'as_columns', 'only', 'defer')) \
+                and not getattr(dbm, 'in_transaction', False):  # 事务中的读取需要看到自己的写入
+            rows = replica.lookup(where, args)  # 等值条件的查询使用内存中的快照
+        if rows is not None:
+            objs = cls._hydrate([dict(r) for r in rows], kw.get('compact'))
+        else:
+            objs, _ = await cls._query_projection(dbm, where, args, kw)  # perform the execute
+        if kw.get('prefetch'):
+            await cls.prefetch_related(dbm, objs, *kw['prefetch'])
+        return objs
+
+    @classmethod
+    async def prefetch_related(cls, dbm, objs, *names):
+        """
+        load the relations of the objects, one in (...) query for each relation. the related objects are stored as obj[name]
+        :param dbm: dbm
+        :param objs: list of objects of this model
+        :param names: names of the relations
+        :return: objs
+        """
+        if not objs:
+            return objs
+        if not isinstance(objs[0], BasicModel):
+            raise ValueError('Relations can not be attached to compact rows')
+        for name in names:
+            relation = cls.__relations__.get(name)
+            if relation is None:
+                raise ValueError('"%s" is not a relation of %s' % (name, cls.__name__))
+            await relation.prefetch(dbm, objs)
+        return objs
+
+    async def fetch_related(self, dbm, *names):
+        """
+        load the relations of this object
+        :param dbm: dbm
+        :param names: names of the relations, default is all of them
+        :return:
+        """
+        await self.prefetch_related(dbm, [self], *(names or self.__relations__.keys()))
 
-        if where:
-            sql.append('where')
-            sql.append(where)
+    @classmethod
+    async def iter_all(cls, dbm, where=None, args=None, batch_size=1000, keyset=False, **kw):
+        """
+        asynchronous generator over the result. the memory is bounded by batch_size.
+        the default mode streams the result with inner_select_on_large (SSDictCursor), so the consumer must be quick,
+        see inner_select_on_large. keyset mode pages by primary keys with query_page and holds no connection between batches.
+        in transaction() or connection() the pinned connection can not stream, keyset mode is used if there is no orderBy and limit,
+        otherwise the whole result is read at once
+        :param dbm: dbm
+        :param where: where sql, the placeholder is ?
+        :param args: arguments for placeholders
+        :param batch_size: number of rows fetched at a time
+        :param keyset: page by primary keys instead of streaming. the order is the primary keys, so it can not be combined with orderBy or limit
+        :param kw: orderBy: string; limit: int; compact: yield compact rows; cursor: 'tuple' uses SSCursor
+        :return: async generator of objects
+        """
+        compact = kw.get('compact')
+        ordered = kw.get('orderBy', None) is not None or kw.get('limit', None) is not None
+        buffered = False
+        if getattr(dbm, 'connection_pinned', False) and not keyset:  # 流式读取的时候, 同一个连接上的其他语句会丢弃剩余的行
+            try:
+                cls._keyset_columns()
+                keyset = not ordered
+            except NotImplementedError:
+                pass
+            buffered = not keyset
+        if keyset:
+            if ordered:
+                raise TypeError('orderBy and limit can not be used with keyset=True, the result is ordered by the primary keys of %s' % cls.__name__)
+            after = None
+            while True:
+                objs, after = await cls.query_page(dbm, where, args, after=after, size=batch_size, compact=compact)
+                for obj in objs:
+                    yield obj
+                if after is None:
+                    break
+        else:
+            sql, args = cls._compile_query(where, args, kw.get('orderBy', None), kw.get('limit', None))
+            columns = cls.__columns__ if (kw.get('cursor') or cls.__cursor__) == 'tuple' and cls.__columns__ else None
+            if buffered:
+                rs = await dbm.inner_select(sql, args, cursor='tuple' if columns else 'dict')
+                for i in range(0, len(rs), batch_size):
+                    for obj in cls._hydrate(rs[i:i + batch_size], compact, columns):
+                        yield obj
+                return
+            async with dbm.inner_select_on_large(sql, args, cursor='tuple' if columns else 'dict') as cur:
+                while True:
+                    rs = await cur.fetchmany(batch_size)
+                    if not rs:
+                        break
+                    for obj in cls._hydrate(rs, compact, columns):
+                        yield obj
 
-        if args is None:
-            args = []
+    @classmethod
+    async def iter_columns(cls, dbm, where=None, args=None, batch_size=10000, **kw):
+        """
+        streaming form of query_all(..., as_columns=True). the result is read with SSCursor,
+        or at once in transaction() or connection() whose pinned connection can not stream
+        :param dbm: dbm
+        :param where: where sql, the placeholder is ?
+        :param args: arguments for placeholders
+        :param batch_size: number of rows in every chunk
+        :param kw: orderBy: string; limit: int
+        :return: async generator of dict, column name -> numpy array
+        """
+        if not cls.__columns__:
+            raise ValueError('Columnar result is not available for "%s" whose columns are unknown' % cls.__name__)
+        from ap_database.columnar import to_columns
+        sql, args = cls._compile_query(where, args, kw.get('orderBy', None), kw.get('limit', None))
+        if getattr(dbm, 'connection_pinned', False):
+            rs = await dbm.inner_select(sql, args, cursor='tuple')
+            for i in range(0, len(rs), batch_size):
+                yield to_columns(cls, rs[i:i + batch_size], cls.__columns__)
+            return
+        async with dbm.inner_select_on_large(sql, args, cursor='tuple') as cur:
+            while True:
+                rs = await cur.fetchmany(batch_size)
+                if not rs:
+                    break
+                yield to_columns(cls, rs, cls.__columns__)
 
-        orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
-
-        limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?,?')
-                args.extend(limit)
+    @classmethod
+    def _keyset_columns(cls):
+        """
+        columns used by keyset pagination
+        :return: list of (column in sql, column name in result)
+        """
+        raise NotImplementedError('Keyset pagination needs primary keys')
+
+    @classmethod
+    async def query_page(cls, dbm, where=None, args=None, after=None, size=100, **kw):
+        """
+        keyset pagination: fetch the rows whose primary keys are greater than after, ordered by primary keys.
+        it uses the index of primary keys, so a deep page is as fast as the first one
+        :param dbm: dbm
+        :param where: where sql, the placeholder is ?
+        :param args: arguments for placeholders
+        :param after: primary key values (tuple) returned by the previous page, None for the first page
+        :param size: page size
+        :param kw: compact: return compact rows
+        :return: (objects, key for the next page or None if it is the last page)
+        """
+        columns = cls._keyset_columns()
+        args = list(args) if args else []
+        if after is not None:
+            if not isinstance(after, (tuple, list)):
+                after = (after, )
+            if len(after) != len(columns):
+                raise ValueError('Invalid after value: %s' % str(after))
+            if len(columns) == 1:
+                cond = '%s > ?' % columns[0][0]
             else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        # rs = await select(pool, ' '.join(sql), args)
-        rs = await dbm.inner_select(' '.join(sql), args)  # perform the execute
-        return [cls(**r) for r in rs]
+                cond = '(%s) > (%s)' % (','.join(c for c, _ in columns), create_args_string(len(columns)))
+            where = '(%s) and %s' % (where, cond) if where else cond
+            args.extend(after)
+        sql, args = cls._compile_query(where, args, ','.join(c for c, _ in columns), size)
+        rs = await dbm.inner_select(sql, args)
+        after = tuple(rs[-1][label] for _, label in columns) if len(rs) == size else None
+        return cls._hydrate(rs, kw.get('compact')), after
 
     @classmethod
-    async def query_count(cls, dbm, where=None, args=None):
+    async def query_count(cls, dbm, where=None, args=None, approximate=False):
         """
-        find how many records in table. Always count *
+        find how many records in table. Always count *. the result is cached if __count_cache__ is set
         :param dbm:
         :param where:
         :param args:
+        :param approximate: return the estimate of MySQL instead of counting: TABLE_ROWS of information_schema.TABLES
+        if there is no where clause, otherwise the rows estimated by EXPLAIN
         :return: number of records
         """
-        sql = ['select COUNT(*) from `%s`' % cls.__table__]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = await dbm.inner_select(' '.join(sql), args, 1)
-        if len(rs) == 0:
-            return 0
-        return rs[0]['COUNT(*)']  # DictCursor
+        cache = cls.__count_cache__ if not getattr(dbm, 'in_transaction', False) else None  # 事务中的结果可能被回滚
+        if cache is not None:
+            key = (where, tuple(args) if args else (), approximate)
+            num = cache.get(key)
+            if num is not None:
+                return num
+            generation = count_generation(cls.__count_tables__)
+        if approximate:
+            num = await cls._estimate_count(dbm, where, args)
+        else:
+            sql, sql_args = cls._compile_query(where, args, head='select COUNT(*) from %s' % cls.__from__)
+            rs = await dbm.inner_select(sql, sql_args, 1)
+            num = rs[0]['COUNT(*)'] if len(rs) > 0 else 0  # DictCursor
+        if cache is not None and count_generation(cls.__count_tables__) == generation:  # 计数期间写入了表, 结果可能已经过期
+            cache.set(key, num)
+        return num
+
+    @classmethod
+    async def _estimate_count(cls, dbm, where=None, args=None):
+        """
+        estimate the number of records without scanning the table
+        :param dbm:
+        :param where:
+        :param args:
+        :return: number of records estimated by MySQL
+        """
+        if not where and getattr(cls, '__table__', None):
+            rs = await dbm.inner_select('select TABLE_ROWS from information_schema.TABLES where TABLE_SCHEMA = database() and TABLE_NAME = ?', [cls.__table__], 1)
+            if len(rs) > 0 and rs[0]['TABLE_ROWS'] is not None:
+                return int(rs[0]['TABLE_ROWS'])
+        sql, sql_args = cls._compile_query(where, args, head='explain select * from %s' % cls.__from__)
+        rs = await dbm.inner_select(sql, sql_args)
+        num = 1.0
+        for r in rs:  # 连接的表, 每一个表估计的行数相乘
+            num *= (r.get('rows') or 0) * (r.get('filtered') or 100) / 100.0
+        return int(num) if rs else 0
+
+    @classmethod
+    def count_cache_stats(cls):
+        """
+        counters of the count cache
+        :return: dict or None if the cache is disabled
+        """
+        return cls.__count_cache__.stats() if cls.__count_cache__ is not None else None
+
+    @classmethod
+    async def aggregate(cls, dbm, where=None, args=None, group_by=None, having=None, having_args=None, orderBy=None, limit=None, **aggregates):
+        """
+        compute the aggregates in MySQL, e.g. Order.aggregate(dbm, 'state=?', [1], group_by='user_id', total=Sum('amount'))
+        :param dbm: dbm
+        :param where: where sql, the placeholder is ?
+        :param args: arguments for placeholders
+        :param group_by: name or list of names of the fields or columns to group by
+        :param having: having sql, the placeholder is ?. it can use the names of the aggregates
+        :param having_args: arguments for placeholders in having
+        :param orderBy: order by sql. it can use the names of the aggregates
+        :param limit: int or tuple of (offset, size)
+        :param aggregates: name of the result -> instance of Aggregate
+        :return: list of namedtuples whose fields are the grouped columns and the aggregates.
+        without group_by, one namedtuple (or None if it is filtered by having)
+        """
+        if not aggregates:
+            raise ValueError('No aggregate specified')
+        if isinstance(group_by, str):
+            group_by = (group_by, )
+        groups = [cls._column_label(g) for g in group_by or ()]
+        exprs = [cls._column_expr(g) for g in groups]
+        select = ['%s as `%s`' % (expr, g) for expr, g in zip(exprs, groups)]
+        for name, agg in aggregates.items():
+            if not isinstance(agg, Aggregate):
+                raise ValueError(str(agg) + '不是 "Aggregate"的一个实例。')
+            select.append('%s as `%s`' % (agg.sql(cls), name))
+        args = list(args) if args else []
+        args.extend(having_args or ())
+        sql, args = cls._compile_query(where, args, orderBy, limit, head='select %s from %s' % (', '.join(select), cls.__from__),
+                                       groupBy=', '.join(exprs), having=having)
+        rs = await dbm.inner_select(sql, args, cursor='tuple')
+        result_type = _aggregate_type(groups + list(aggregates.keys()))
+        rows = [result_type._make(r) for r in rs]
+        if groups:
+            return rows
+        return rows[0] if rows else None
 
     @classmethod
     async def query_with_primary_keys(cls, dbm, **primarykeys):
@@ -385,24 +1435,308 @@ class BasicModel(dict):
         if len(primarykeys) < pri_size:  # 可以多，但是不能少
             raise RuntimeError("Not enough primary key(s) specified")  # 主键长度不完整
         pri_keys = [primarykeys.get(pri_fieldName) for pri_fieldName in cls.__primary_keys__]
-
-        rs = await dbm.inner_select('%s where %s' % (cls.__select__, cls.__primary_key_fields__), pri_keys, 1)
+        in_transaction = getattr(dbm, 'in_transaction', False)  # 事务中的读取需要看到自己的写入, 不使用缓存和快照
+        if cls.__replica__ is not None and not in_transaction:
+            rows = cls.__replica__.find(tuple(cls.__primary_keys__), pri_keys)
+            if rows is not None:
+                return cls._hydrate([dict(rows[0])], False)[0] if rows else None
+        cache = cls.__cache__ if not in_transaction else None
+        if cache is None:
+            rs = await dbm.inner_select(cls.__select_pk__, pri_keys, 1)
+        else:
+            row = cache.get(tuple(pri_keys))
+            if row is not None:
+                return cls._hydrate([row], False)[0]  # 每次都创建新的对象, 缓存的行不会被修改
+            token = cls._begin_cache_fill(tuple(pri_keys))
+            rs = []
+            try:
+                rs = await dbm.inner_select(cls.__select_pk__, pri_keys, 1)
+            finally:
+                cls._end_cache_fill(token, dbm, rs[0] if rs else None)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        return cls._hydrate(rs, False)[0]
+
+    @classmethod
+    def _begin_cache_fill(cls, key):
+        """
+        register a read which may fill the primary key cache. a write of the key during the read is detected by the generation
+        :param key: tuple of the primary key values
+        :return: token for _end_cache_fill
+        """
+        entry = cls.__cache_fills__.get(key)
+        if entry is None:
+            entry = cls.__cache_fills__[key] = [0, 0]
+        entry[0] += 1
+        return key, entry, entry[1]
+
+    @classmethod
+    def _end_cache_fill(cls, token, dbm, row):
+        """
+        finish the read and fill the cache unless the key is written during the read
+        :param token: returned by _begin_cache_fill
+        :param dbm:
+        :param row: the row read or None
+        :return:
+        """
+        key, entry, generation = token
+        entry[0] -= 1
+        if entry[0] == 0 and cls.__cache_fills__.get(key) is entry:
+            del cls.__cache_fills__[key]
+        if row is None or entry[1] != generation:
+            return
+        if tuple(row.get(pk) for pk in cls.__primary_keys__) == key:  # 类型不同的键(例如字符串)不缓存, 否则写入的时候不能失效
+            cls.__cache__.set(key, row)
+
+    @classmethod
+    async def query_many_with_primary_keys(cls, dbm, keys):
+        """
+        find objects by many primary keys with one query (where pk in (...)). the primary key cache is used if enabled
+        :param dbm:
+        :param keys: iterable of tuples, the values of primary keys in the order of __primary_keys__
+        :return: dict, key (as given) -> object. the keys not found are not included
+        """
+        keys = list(dict.fromkeys(keys))  # 去掉重复的主键, 保持顺序
+        rows = dict()
+        in_transaction = getattr(dbm, 'in_transaction', False)  # 事务中的读取需要看到自己的写入, 不使用缓存和快照
+        replica = cls.__replica__ if not in_transaction else None
+        if replica is not None:
+            served = [(key, replica.find(tuple(cls.__primary_keys__), key)) for key in keys]
+            if all(found is not None for _, found in served):
+                return {key: cls._hydrate([dict(found[0])], False)[0] for key, found in served if found}
+        cache = cls.__cache__ if not in_transaction else None
+        missing = keys
+        if cache is not None:
+            missing = []
+            for key in keys:
+                row = cache.get(key)
+                if row is None:
+                    missing.append(key)
+                else:
+                    rows[key] = row
+        if missing:
+            args = []
+            for key in missing:
+                args.extend(key)
+            tokens = [cls._begin_cache_fill(key) for key in missing] if cache is not None else []
+            found = dict()
+            try:
+                # 主键的数量每次都不同, 不放入 statement_cache
+                rs = await dbm.inner_select(compile_sql('%s where %s' % (cls.__select__, cls._primary_keys_in(len(missing)))), args)
+                for r in rs:
+                    found[tuple(r.get(pk) for pk in cls.__primary_keys__)] = r
+            finally:
+                for token in tokens:
+                    cls._end_cache_fill(token, dbm, found.get(token[0]))
+            unmatched = len(found)
+            for key in missing:
+                if key in found:
+                    rows[key] = found[key]
+                    unmatched -= 1
+            if unmatched:
+                # MySQL 比较的时候会转换类型或者使用排序规则(例如 '5' 与 5, 大小写不敏感), 返回的主键与请求的不同. 没有对应的行的主键单独查询
+                for key in missing:
+                    if key not in found:
+                        rs = await dbm.inner_select(cls.__select_pk__, list(key), 1)
+                        if rs:
+                            rows[key] = rs[0]
+        return dict(zip(rows.keys(), cls._hydrate(list(rows.values()), False)))
+
+    @classmethod
+    async def load_replica(cls, dbm, refresh_interval=None):
+        """
+        load the whole table into memory, see __replicated__. the snapshot is reloaded after the writes through the ORM
+        :param dbm:
+        :param refresh_interval: seconds, also reload the snapshot periodically. it is required by the views without __base_tables__
+        :return: number of rows
+        """
+        replica = cls.__replica__
+        if replica is None:
+            raise ValueError('"%s" is not replicated, please set __replicated__' % cls.__name__)
+        if not replica.tables and not refresh_interval:
+            raise ValueError('The snapshot of "%s" is never reloaded, please set __base_tables__ or refresh_interval' % cls.__name__)
+        num = await replica.load(dbm)
+        if refresh_interval:
+            replica.start(dbm, refresh_interval)
+        return num
+
+    @classmethod
+    def replica_stats(cls):
+        """
+        counters of the in-memory replica
+        :return: dict or None if the model is not replicated
+        """
+        return cls.__replica__.stats() if cls.__replica__ is not None else None
+
+    @classmethod
+    def cache_stats(cls):
+        """
+        counters of the primary key cache
+        :return: dict or None if the cache is disabled
+        """
+        return cls.__cache__.stats() if cls.__cache__ is not None else None
 
 
 class Model(BasicModel, metaclass=ModelMetaclass):
 
+    # 从数据库读取之后被赋值的属性. None 表示对象不是从数据库中读取的, 这时 save_change 会更新所有的属性
+    _changed = None
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
+    def __setitem__(self, key, value):
+        changed = self._changed
+        if changed is not None and key in self.__mappings__:
+            changed.add(key)
+        super(Model, self).__setitem__(key, value)
+
+    def _mark_clean(self):
+        """
+        forget the changed fields, called after the object is loaded from or written to the table
+        :return:
+        """
+        object.__setattr__(self, '_changed', set())  # 不能保存在 dict 中
+
+    @classmethod
+    def _hydrate(cls, rs, compact=None, columns=None):
+        objs = super(Model, cls)._hydrate(rs, compact, columns)
+        if objs and isinstance(objs[0], Model):
+            for obj in objs:
+                obj._mark_clean()
+        return objs
+
+    @classmethod
+    def _update_sql(cls, fields):
+        """
+        get the update statement which only sets the given fields
+        :param fields: tuple of non-primary-key fields
+        :return: sql
+        """
+        sql = cls.__update_cache__.get(fields)
+        if sql is None:
+            sql = compile_sql('update `%s` set %s where %s' % (
+                cls.__table__, ', '.join(map(lambda f: '`%s`=?' % (cls.__mappings__[f].name or f), fields)), cls.__primary_key_fields__))
+            cls.__update_cache__[fields] = sql
+        return sql
+
+    def _check_loaded(self, fields):
+        """
+        make sure the fields to write are loaded. the columns deferred by the projection query would be written as NULL or the default
+        :param fields: names of the fields to write
+        :return:
+        """
+        deferred = self._deferred
+        if not deferred:
+            return
+        unloaded = [f for f in fields if f not in self and self._column_label(f) in deferred]
+        if unloaded:
+            raise ValueError('Can not write %s loaded with only/defer, the field(s) are not loaded: %s. please call "await obj.load_deferred(dbm)" first'
+                             % (self.__class__.__name__, ', '.join(unloaded)))
+
+    def _primary_key_values(self):
+        """
+        values of the primary keys in the order of __primary_keys__
+        :return: tuple
+        """
+        return tuple(map(self.getValue, self.__primary_keys__))
+
+    @classmethod
+    def _keyset_columns(cls):
+        return [('`%s`' % (cls.__mappings__[k].name or k), k) for k in cls.__primary_keys__]
+
+    @classmethod
+    def _after_write(cls, objs, dbm=None):
+        """
+        called after the objects are inserted, updated or deleted. invalidate the cached entries,
+        after the commit if the write is in a transaction of dbm
+        :param objs: iterable of objects
+        :param dbm: the manager which performed the write
+        :return:
+        """
+        keys = [obj._primary_key_values() for obj in objs]
+        if getattr(dbm, 'in_transaction', False):
+            dbm.after_commit(lambda: cls._invalidate(keys))  # 回滚的时候丢弃
+        else:
+            cls._invalidate(keys)
+
+    @classmethod
+    def _invalidate(cls, keys):
+        """
+        invalidate the cached entries of the primary keys, the cached counts and the replica
+        :param keys: list of tuples of the primary key values
+        :return:
+        """
+        cache = cls.__cache__
+        if cache is not None:
+            fills = cls.__cache_fills__
+            for key in keys:
+                cache.invalidate(key)
+                entry = fills.get(key)
+                if entry is not None:
+                    entry[1] += 1  # 进行中的读取不再写入缓存
+        invalidate_counts(cls.__table__)
+        invalidate_replicas(cls.__table__)  # 包括读取这个表的视图
+
+    @classmethod
+    def _primary_keys_in(cls, num):
+        """
+        create the condition matching any of num primary keys. the arguments are the flattened primary key values
+        :param num: number of keys
+        :return: sql, the placeholder is ?
+        """
+        if len(cls.__primary_keys__) == 1:
+            pk = cls.__primary_keys__[0]
+            return '`%s` in (%s)' % (cls.__mappings__[pk].name or pk, create_args_string(num))
+        return ' or '.join(['(%s)' % cls.__primary_key_fields__] * num)
+
+    @classmethod
+    def _update_many_statement(cls, objs, fields):
+        """
+        create one update statement for objects sharing the same changed fields
+        :param objs: list of objects
+        :param fields: tuple of non-primary-key fields
+        :return: (CompiledSQL, args)
+        """
+        if len(objs) == 1:
+            obj = objs[0]
+            args = list(map(obj.getValue, fields))
+            args.extend(obj._primary_key_values())
+            return cls._update_sql(fields), args
+        keys = [obj._primary_key_values() for obj in objs]
+        cases = ' '.join(['when %s then ?' % cls.__primary_key_fields__] * len(objs))
+        set_clause = []
+        args = []
+        for f in fields:
+            column = cls.__mappings__[f].name or f
+            set_clause.append('`%s`=case %s else `%s` end' % (column, cases, column))
+            for key, obj in zip(keys, objs):
+                args.extend(key)
+                args.append(obj.getValue(f))
+        for key in keys:
+            args.extend(key)
+        sql = 'update `%s` set %s where %s' % (cls.__table__, ', '.join(set_clause), cls._primary_keys_in(len(objs)))
+        return compile_sql(sql), args
+
+    @classmethod
+    def _delete_many_statement(cls, objs):
+        """
+        create one delete statement for objects
+        :param objs: list of objects
+        :return: (CompiledSQL, args)
+        """
+        args = []
+        for obj in objs:
+            args.extend(obj._primary_key_values())
+        return compile_sql('delete from  `%s` where %s' % (cls.__table__, cls._primary_keys_in(len(objs)))), args
+
     async def insert(self, dbm):
         """
         insert this object into table
         :param dbm:
         :return: number of affected rows
         """
+        self._check_loaded(self.__fields__)
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.extend(list(map(self.getValueOrDefault, self.__primary_keys__)))
 
@@ -410,19 +1744,146 @@ class Model(BasicModel, metaclass=ModelMetaclass):
         rows = await dbm.inner_execute(self.__insert__, args)
         if rows != 1:
             server_warning('Failed to insert an entry, effected row(s): %d' % rows)  # 插入一条记录失败: 受影响 rows 的数量: %s
+        self._mark_clean()
+        self._after_write((self, ), dbm)
         return rows
 
+    @classmethod
+    def _iter_batches(cls, objs, head, suffix='', batch_rows=1000, batch_bytes=1048576, written=None, keep_falsy=False):
+        """
+        split the objects into multi-row insert statements
+        :param objs: iterable of model objects or dicts
+        :param head: head of the statement, e.g. __insert_head__
+        :param suffix: appended to every statement
+        :param batch_rows: maximum rows in one statement
+        :param batch_bytes: approximate maximum size of the arguments in one statement
+        :param written: fields which must be loaded, see _check_loaded. None means all the fields
+        :param keep_falsy: only None is replaced by the default, see _value_or_default. set by upsert_many
+        :return: generator of (sql, args, objects in this batch)
+        """
+        if batch_rows < 1:
+            raise ValueError('Invalid batch_rows value: %s' % str(batch_rows))
+        columns = cls.__fields__ + cls.__primary_keys__
+        row_sql = cls.__insert_row__
+        batch, args, size = [], [], 0
+        for obj in objs:
+            if not isinstance(obj, cls):
+                obj = cls(**obj)
+            obj._check_loaded(cls.__fields__ if written is None else written)
+            value = obj._value_or_default if keep_falsy else obj.getValueOrDefault
+            row_args = [value(k) for k in columns]  # 一次遍历就填充了默认值
+            row_size = len(row_sql) + sum(len(a) if isinstance(a, (str, bytes)) else 8 for a in row_args)
+            if batch and (len(batch) >= batch_rows or size + row_size > batch_bytes):
+                yield CompiledSQL(head + ', '.join([row_sql] * len(batch)) + suffix), args, batch
+                batch, args, size = [], [], 0
+            batch.append(obj)
+            args.extend(row_args)
+            size += row_size
+        if batch:
+            yield CompiledSQL(head + ', '.join([row_sql] * len(batch)) + suffix), args, batch
+
+    @classmethod
+    async def insert_many(cls, dbm, objs, batch_rows=1000, batch_bytes=1048576):
+        """
+        insert objects with multi-row insert statements, one round trip per batch
+        :param dbm:
+        :param objs: iterable of model objects or dicts
+        :param batch_rows: maximum rows in one statement
+        :param batch_bytes: approximate maximum size of the arguments in one statement. see max_allowed_packet of MySQL
+        :return: list of affected rows of every batch
+        """
+        results = []
+        for sql, args, batch in cls._iter_batches(objs, cls.__insert_head__, batch_rows=batch_rows, batch_bytes=batch_bytes):
+            rows = await dbm.inner_execute(sql, args)
+            if rows != len(batch):
+                server_warning('Failed to insert %d entries, effected row(s): %d' % (len(batch), rows))
+            for obj in batch:
+                obj._mark_clean()
+            cls._after_write(batch, dbm)
+            results.append(rows)
+        return results
+
+    @classmethod
+    def _upsert_suffix(cls, update_fields=None):
+        """
+        get the 'on duplicate key update' clause which only updates the given fields
+        :param update_fields: iterable of non-primary-key fields. None means all the fields
+        :return: sql clause
+        """
+        if update_fields is None:
+            update_fields = cls.__fields__
+        key = tuple(update_fields)
+        suffix = cls.__upsert_cache__.get(key)
+        if suffix is None:
+            for f in key:
+                if f not in cls.__fields__:
+                    raise ValueError('"%s" is not a non-primary-key field of %s' % (f, cls.__name__))
+            suffix = upsert_suffix(key or cls.__primary_keys__[:1])  # 主键更新为自身, 相当于存在的时候不做修改
+            cls.__upsert_cache__[key] = suffix
+        return suffix
+
+    async def upsert(self, dbm, update_fields=None):
+        """
+        insert this object or update it if the primary key exists, in one round trip.
+        note that MySQL reports 1 affected row for insert, 2 for update and 0 if nothing changed
+        :param dbm:
+        :param update_fields: fields to update when the primary key exists. None means all the fields
+        :return: number of affected rows
+        """
+        self._check_loaded(self.__fields__ if update_fields is None else update_fields)
+        # 更新的部分使用相同的值, 所以 0, False 等不能被替换为默认值
+        args = list(map(self._value_or_default, self.__fields__))
+        args.extend(list(map(self._value_or_default, self.__primary_keys__)))
+        sql = self.__upsert__ if update_fields is None else CompiledSQL(self.__insert__ + self._upsert_suffix(update_fields))
+        rows = await dbm.inner_execute(sql, args)
+        self._mark_clean()
+        self._after_write((self, ), dbm)
+        return rows
+
+    @classmethod
+    async def upsert_many(cls, dbm, objs, update_fields=None, batch_rows=1000, batch_bytes=1048576):
+        """
+        batched form of upsert
+        :param dbm:
+        :param objs: iterable of model objects or dicts
+        :param update_fields: fields to update when the primary key exists. None means all the fields
+        :param batch_rows: maximum rows in one statement
+        :param batch_bytes: approximate maximum size of the arguments in one statement
+        :return: list of affected rows of every batch
+        """
+        suffix = cls._upsert_suffix(update_fields)
+        results = []
+        for sql, args, batch in cls._iter_batches(objs, cls.__insert_head__, suffix, batch_rows, batch_bytes, update_fields, keep_falsy=True):
+            results.append(await dbm.inner_execute(sql, args))
+            for obj in batch:
+                obj._mark_clean()
+            cls._after_write(batch, dbm)
+        return results
+
     async def save_change(self, dbm):
         """
-        update this in table except primary key
+        update this in table except primary key. if the object is loaded from table, only the fields assigned
+        since then are updated, and nothing is sent when no field is changed
         :param dbm:
         :return: number of affected rows
         """
-        args = list(map(self.getValue, self.__fields__))
+        changed = self._changed
+        if changed is None:
+            sql, fields = self.__update__, self.__fields__
+        else:
+            fields = tuple(f for f in self.__fields__ if f in changed)  # 按照定义的顺序, 作为缓存的键
+            if not fields:
+                server_debug('Nothing changed in %s, skip the update' % self.__class__.__name__)
+                return 0
+            sql = self._update_sql(fields)
+        self._check_loaded(fields)
+        args = list(map(self.getValue, fields))
         args.extend(list(map(self.getValue, self.__primary_keys__)))
-        rows = await dbm.inner_execute(self.__update__, args)
+        rows = await dbm.inner_execute(sql, args)
         if rows != 1:
             server_warning('Failed to update an entry, effected row(s): %d' % rows)
+        self._mark_clean()
+        self._after_write((self, ), dbm)
         return rows
 
     async def delete(self, dbm):
@@ -435,14 +1896,93 @@ class Model(BasicModel, metaclass=ModelMetaclass):
         rows = await dbm.inner_execute(self.__delete__, args)
         if rows != 1:
             server_warning('Failed to delete an entry, effected row(s): %d' % rows)
+        self._after_write((self, ), dbm)
         return rows
 
+    @classmethod
+    def ddl(cls, if_not_exists=True):
+        """
+        generate the create table statement from __mappings__, __primary_keys__ and __indexes__
+        :param if_not_exists: add 'if not exists'
+        :return: sql
+        """
+        lines = []
+        for k in cls.__primary_keys__ + cls.__fields__:
+            field = cls.__mappings__[k]
+            column_type = 'varchar(255)' if field.column_type == 'var' else field.column_type  # StringField 默认的类型
+            lines.append('`%s` %s%s' % (field.name or k, column_type, ' not null' if field.primary_key else ''))
+        lines.append('primary key (%s)' % ', '.join('`%s`' % (cls.__mappings__[k].name or k) for k in cls.__primary_keys__))
+        lines.extend(index.sql() for index in cls.__indexes__)
+        return 'create table %s`%s` (\n  %s\n) engine=InnoDB default charset=utf8mb4' % (
+            'if not exists ' if if_not_exists else '', cls.__table__, ',\n  '.join(lines))
+
+    @classmethod
+    async def create_table(cls, dbm, if_not_exists=True):
+        """
+        create the table with the declared indexes
+        :param dbm:
+        :param if_not_exists: do nothing if the table exists
+        :return:
+        """
+        sql = cls.ddl(if_not_exists)
+        server_info('Create table of %s: %s' % (cls.__name__, sql))
+        await dbm.inner_execute(sql, ())
+
+    @classmethod
+    async def missing_indexes(cls, dbm):
+        """
+        find the declared indexes which are not in the live schema. an existing index on the same leading columns is accepted
+        :param dbm:
+        :return: list of Index
+        """
+        rs = await dbm.inner_select('select INDEX_NAME, COLUMN_NAME, NON_UNIQUE from information_schema.STATISTICS '
+                                    'where TABLE_SCHEMA = database() and TABLE_NAME = ? order by INDEX_NAME, SEQ_IN_INDEX', [cls.__table__])
+        live = dict()  # 索引名 -> (列, 是否唯一)
+        for r in rs:
+            columns, unique = live.get(r['INDEX_NAME'], ((), not int(r['NON_UNIQUE'])))
+            live[r['INDEX_NAME']] = (columns + (r['COLUMN_NAME'], ), unique)
+        return [index for index in cls.__indexes__ if not any(index.covered_by(columns, unique) for columns, unique in live.values())]
+
+    @classmethod
+    async def check_indexes(cls, dbm):
+        """
+        warn about the declared indexes which are missing in the live schema
+        :param dbm:
+        :return: list of missing Index
+        """
+        missing = await cls.missing_indexes(dbm)
+        for index in missing:
+            server_warning('Index %s of %s is missing in table `%s`: %s' % (index.name, cls.__name__, cls.__table__, index.sql()))
+        return missing
+
+    @classmethod
+    async def sync_indexes(cls, dbm):
+        """
+        add the missing indexes to the table. the indexes not declared are never dropped
+        :param dbm:
+        :return: list of created Index
+        """
+        missing = await cls.missing_indexes(dbm)
+        for index in missing:
+            sql = 'alter table `%s` add %s' % (cls.__table__, index.sql())
+            server_info('Add index of %s: %s' % (cls.__name__, sql))
+            await dbm.inner_execute(sql, ())
+        return missing
+
 
 class TempModel(BasicModel, metaclass=TempModelMetaclass):
 
     def __init__(self, **kw):
         super(TempModel, self).__init__(**kw)
 
+    @classmethod
+    def _keyset_columns(cls):
+        if not cls.__primaryKey__:
+            raise NotImplementedError('Keyset pagination needs the primary key of the temporary model')
+        pkName, pkObj = cls.__primaryKey__
+        column = pkObj.name if pkObj.name else pkName
+        return [('%s`%s`' % (pkObj.prefix, column), cls.__labels__[pkName])]
+
     @classmethod
     async def query_all(cls, dbm, where=None, args=None, **kw):
         """
@@ -450,52 +1990,32 @@ class TempModel(BasicModel, metaclass=TempModelMetaclass):
         :param dbm: 数据库管理对象
         :param where: where 子句
         :param args: where 查询的参数
-        :param kw: 其他参数，orderBy 表示排序;limit 表示限制的结果过数量;toDict 表示是否将结果转换为 dict 形式
+        :param kw: 其他参数，orderBy 表示排序;limit 表示限制的结果过数量;toDict 表示是否将结果转换为 dict 形式;compact 表示使用紧凑的行对象;cursor 为 tuple 表示使用元组游标;as_columns 表示返回每一列的 numpy 数组;only/defer 表示只读取部分的列
         :return:
         """
         toDict = kw.get('toDict', False)
-        sql = [cls.__select__]
-
-        if where:
-            sql.append('where')
-            sql.append(where)
-
-        if args is None:
-            args = []
-
         orderBy = kw.get('orderBy', None)
-        if orderBy:
-            if toDict:
-                raise ValueError("Can't transform result from list to dict object if toDict parameter is specified!")
-            sql.append('order by')
-            sql.append(orderBy)
-
-        limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?,?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await dbm.inner_select(' '.join(sql), args)
+        if orderBy and toDict:
+            raise ValueError("Can't transform result from list to dict object if toDict parameter is specified!")
+        objs, rs = await cls._query_projection(dbm, where, args, kw)
         # 检查是否有主键
-        if toDict:
+        if toDict and not kw.get('as_columns'):
             pkName, pkObj = cls.__primaryKey__  # 获取设置的主键
-            finalKeyName = pkName if not pkObj.name else pkObj.name  # 最终使用的主键的名称
-            if len(rs) > 0:
+            finalKeyName = cls.__labels__[pkName]  # 最终使用的主键的名称, 与其他表的列重名的时候是 别名.列名
+            if len(objs) > 0:
                 # 有结果在才有意义
                 target = dict()
-                for item in rs:
-                    key = item.get(finalKeyName)  # 这个必须要有
-                    target[key] = cls(**item)  # 构建对象
+                if rs is not None:
+                    for item, obj in zip(rs, objs):
+                        key = item.get(finalKeyName)  # 这个必须要有
+                        target[key] = obj
+                else:
+                    for obj in objs:
+                        target[getattr(obj, finalKeyName)] = obj  # 元组游标, 对象的属性就是列名
                 return target
-            return rs
+            return rs if rs is not None else []
         else:
-            return [cls(**r) for r in rs]
+            return objs
 
 
 class ViewTable(BasicModel, metaclass=ViewTableMetaclass):
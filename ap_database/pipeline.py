@@ -0,0 +1,99 @@
+# coding=utf-8
+__author__ = 'Shu Wang <wangshu214@live.cn>'
+__version__ = '0.0.0.1'
+__all__ = ['Pipeline']
+__doc__ = 'Appointed2 - send several independent queries in one round trip'
+
+
+class Pipeline(object):
+
+    """
+    收集多个互相独立的查询, execute 的时候一起发送. 管理器开启了 multi_statements 的时候作为一条多语句发送, 只有一次往返;
+    否则在连接池的多个连接上并发执行. 例如:
+    async with dbm.pipeline() as pipe:
+        total = pipe.query_count(User, 'state=?', [1])
+        users = pipe.query_all(User, 'state=?', [1], orderBy='id', limit=20)
+    print(total.result(), users.result())
+    """
+
+    def __init__(self, dbm):
+        """
+        create a pipeline
+        :param dbm: MySQLManager's instance
+        """
+        self.dbm = dbm
+        self._statements = []  # (sql, args, cursor, transform, future)
+
+    def __len__(self):
+        return len(self._statements)
+
+    def select(self, sql, args=None, cursor='dict', transform=None):
+        """
+        queue a select
+        :param sql: sql, placeholder is ?
+        :param args: arguments for placeholders
+        :param cursor: 'dict' or 'tuple', see inner_select
+        :param transform: callable applied to the rows
+        :return: future of the result, available after execute
+        """
+        future = self.dbm.loop.create_future()
+        self._statements.append((sql, args, cursor, transform, future))
+        return future
+
+    def query_all(self, model_type, where=None, args=None, **kw):
+        """
+        queue a query of the model
+        :param model_type: subclass of BasicModel
+        :param where: where sql, the placeholder is ?
+        :param args: arguments for placeholders
+        :param kw: orderBy, limit and compact, see BasicModel.query_all
+        :return: future of the list of objects
+        """
+        sql, sql_args = model_type._compile_query(where, args, kw.get('orderBy', None), kw.get('limit', None))
+        compact = kw.get('compact')
+        return self.select(sql, sql_args, transform=lambda rs: model_type._hydrate(rs, compact))
+
+    def query_count(self, model_type, where=None, args=None):
+        """
+        queue a count of the model
+        :param model_type: subclass of BasicModel
+        :param where: where sql, the placeholder is ?
+        :param args: arguments for placeholders
+        :return: future of the number
+        """
+        sql, sql_args = model_type._compile_query(where, args, head='select COUNT(*) from %s' % model_type.__from__)
+        return self.select(sql, sql_args, cursor='tuple', transform=lambda rs: rs[0][0] if rs else 0)
+
+    async def execute(self):
+        """
+        send the queued queries and resolve their futures
+        :return: list of the results in the order of queuing
+        """
+        statements, self._statements = self._statements, []
+        if not statements:
+            return []
+        try:
+            await self.dbm.ensureConnected()
+            results = await self.dbm.inner_select_many([(sql, args, cursor) for sql, args, cursor, _, _ in statements])
+            values = [transform(rs) if transform is not None else rs for rs, (_, _, _, transform, _) in zip(results, statements)]
+        except BaseException as e:
+            for _, _, _, _, future in statements:
+                if not future.done():
+                    future.set_exception(e)
+                    future.exception()  # 调用者可能不再读取这个结果
+            raise
+        for value, (_, _, _, _, future) in zip(values, statements):
+            if not future.done():
+                future.set_result(value)
+        return values
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.execute()
+        else:
+            for _, _, _, _, future in self._statements:
+                future.cancel()
+            self._statements = []
@@ -0,0 +1,220 @@
+# coding=utf-8
+__author__ = 'Shu Wang <wangshu214@live.cn>'
+__version__ = '0.0.0.1'
+__all__ = ['QuerySet', 'QuerySetDescriptor']
+__doc__ = 'Appointed2 - lazy and chainable queries of the models'
+
+
+# MySQL 没有只有 offset 的语法, 使用最大的行数
+_MAX_ROWS = 18446744073709551615
+
+
+class QuerySet(object):
+
+    """
+    延迟执行的查询. filter、order_by、limit 以及切片都返回新的 QuerySet, 不执行 SQL;
+    await、async for、first、exists、count 的时候才执行. 例如:
+    users = await User.objects.using(dbm).filter('age>?', 18).filter(state=1).order_by('-age')[:10]
+    生成的语句通过 BasicModel._compile_query 放入 statement_cache
+    """
+
+    def __init__(self, model, dbm=None):
+        """
+        create a query of all the records
+        :param model: subclass of BasicModel
+        :param dbm: SQLManager's instance, see using
+        """
+        self.model = model
+        self.dbm = dbm
+        self._where = ()  # 使用 and 连接的条件
+        self._args = ()
+        self._order = ()
+        self._offset = 0
+        self._size = None
+        self._options = dict()  # query_all 的其他参数
+
+    def _clone(self, **attrs):
+        qs = QuerySet.__new__(QuerySet)
+        qs.__dict__.update(self.__dict__)
+        qs.__dict__.update(attrs)
+        return qs
+
+    def using(self, dbm):
+        """
+        the manager used to execute the query
+        :param dbm: SQLManager's instance
+        :return: QuerySet
+        """
+        return self._clone(dbm=dbm)
+
+    def filter(self, where=None, *args, **fields):
+        """
+        add conditions. all the conditions are joined with 'and'
+        :param where: where sql, the placeholder is ?
+        :param args: arguments for placeholders
+        :param fields: name of field=value. None means 'is null', a list or tuple means 'in'
+        :return: QuerySet
+        """
+        conds, cond_args = list(self._where), list(self._args)
+        if where:
+            conds.append(where)
+            cond_args.extend(args)
+        elif args:
+            raise ValueError('Arguments are specified without where sql')
+        for name, value in fields.items():
+            expr = self.model._column_expr(name)
+            if value is None:
+                conds.append('%s is null' % expr)
+            elif isinstance(value, (list, tuple)):
+                if not value:
+                    raise ValueError('Empty list for the field: %s' % name)
+                conds.append('%s in (%s)' % (expr, ','.join(['?'] * len(value))))
+                cond_args.extend(value)
+            else:
+                conds.append('%s=?' % expr)
+                cond_args.append(value)
+        return self._clone(_where=tuple(conds), _args=tuple(cond_args))
+
+    def order_by(self, *fields):
+        """
+        replace the order. '-name' means descending
+        :param fields: names of the fields or columns
+        :return: QuerySet
+        """
+        order = []
+        for name in fields:
+            if name.startswith('-'):
+                order.append('%s desc' % self.model._column_expr(name[1:]))
+            else:
+                order.append(self.model._column_expr(name))
+        return self._clone(_order=tuple(order))
+
+    def limit(self, size, offset=None):
+        """
+        limit the number of results
+        :param size: maximum number of results
+        :param offset: number of results to skip, default is unchanged
+        :return: QuerySet
+        """
+        if size < 0 or (offset is not None and offset < 0):
+            raise ValueError('Invalid limit value: %s' % str((offset, size)))
+        return self._clone(_size=size, _offset=self._offset if offset is None else offset)
+
+    def options(self, **kw):
+        """
+        other arguments of query_all, e.g. compact, cursor, only, defer
+        :param kw:
+        :return: QuerySet
+        """
+        options = dict(self._options)
+        options.update(kw)
+        return self._clone(_options=options)
+
+    def __getitem__(self, item):
+        """
+        qs[start:stop] is a new QuerySet with limit; qs[i] is an awaitable of the object or None
+        """
+        if isinstance(item, int):
+            if item < 0:
+                raise ValueError('Negative index is not supported')
+            return self[item:item + 1].first()
+        if not isinstance(item, slice) or item.step is not None:
+            raise ValueError('Invalid index: %s' % str(item))
+        start, stop = item.start or 0, item.stop
+        if start < 0 or (stop is not None and stop < 0):
+            raise ValueError('Negative index is not supported')
+        offset = self._offset + start
+        if self._size is None:
+            size = None if stop is None else max(stop - start, 0)
+        else:
+            size = max(self._size - start, 0)
+            if stop is not None:
+                size = min(size, max(stop - start, 0))
+        return self._clone(_offset=offset, _size=size)
+
+    def _where_sql(self):
+        return ' and '.join('(%s)' % c for c in self._where) if len(self._where) > 1 else (self._where[0] if self._where else None)
+
+    def _limit(self):
+        if self._size is None:
+            return (self._offset, _MAX_ROWS) if self._offset else None
+        return (self._offset, self._size) if self._offset else self._size
+
+    def _manager(self):
+        if self.dbm is None:
+            raise ValueError('No manager for the query of "%s", please call using(dbm) first' % self.model.__name__)
+        return self.dbm
+
+    def sql(self):
+        """
+        the sql which will be executed by all
+        :return: (sql, arguments)
+        """
+        return self.model._compile_query(self._where_sql(), self._args, ', '.join(self._order) or None, self._limit())
+
+    async def all(self):
+        """
+        execute the query
+        :return: list of objects
+        """
+        if self._size == 0:
+            return []
+        kw = dict(self._options)
+        kw['orderBy'] = ', '.join(self._order) or None
+        kw['limit'] = self._limit()
+        return await self._manager().queryAll(self.model, self._where_sql(), list(self._args), **kw)
+
+    def __await__(self):
+        return self.all().__await__()
+
+    async def __aiter__(self):
+        for obj in await self.all():
+            yield obj
+
+    async def first(self):
+        """
+        the first object
+        :return: object or None
+        """
+        objs = await self[:1].all()
+        return objs[0] if objs else None
+
+    async def exists(self):
+        """
+        whether there is any matched record. only 'select 1 ... limit 1' is executed
+        :return: bool
+        """
+        if self._size == 0:
+            return False
+        dbm = self._manager()
+        sql, args = self.model._compile_query(self._where_sql(), self._args, limit=(self._offset, 1) if self._offset else 1,
+                                              head='select 1 from %s' % self.model.__from__)
+        await dbm.ensureConnected()
+        rs = await dbm.inner_select(sql, args, 1, cursor='tuple')
+        return len(rs) > 0
+
+    async def count(self, approximate=False):
+        """
+        number of the matched records, limited by the slice
+        :param approximate: see BasicModel.query_count
+        :return: number
+        """
+        num = await self._manager().countNum(self.model, self._where_sql(), list(self._args), approximate=approximate)
+        num = max(num - self._offset, 0)
+        return num if self._size is None else min(num, self._size)
+
+    def __repr__(self):
+        sql, args = self.sql()
+        return '<QuerySet %s %s>' % (sql, args)
+
+
+class QuerySetDescriptor(object):
+
+    """
+    Model.objects 返回这个模型的所有记录的 QuerySet. 对象上的 objects 仍然是同名的属性
+    """
+
+    def __get__(self, instance, owner):
+        if instance is not None:
+            raise AttributeError('objects')  # 由 __getattr__ 读取 dict 中的值
+        return QuerySet(owner)
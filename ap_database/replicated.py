@@ -0,0 +1,236 @@
+# coding=utf-8
+__author__ = 'Shu Wang <wangshu214@live.cn>'
+__version__ = '0.0.0.1'
+__all__ = ['ReplicatedTable', 'Snapshot']
+__doc__ = 'Appointed2 - in-memory snapshots of the small and read-mostly tables'
+from asyncio import sleep, CancelledError
+from ap_logger.logger import make_logger
+import re
+
+
+_replicated_logger = make_logger('REPLICATED')
+
+# 简单的等值条件: a=? and `b` = ?
+_equality = re.compile(r'^\s*`?(\w+)`?\s*=\s*\?\s*$')
+_and = re.compile(r'\s+and\s+', re.IGNORECASE)
+
+
+class Snapshot(object):
+
+    """
+    表的某一个时刻的全部的行以及哈希索引. 创建之后不再修改, 刷新的时候整体替换
+    """
+    __slots__ = ('rows', 'indexes', 'types')
+
+    def __init__(self, rows, indexes):
+        """
+        build the snapshot
+        :param rows: list of dict
+        :param indexes: list of tuples of column names
+        """
+        self.rows = rows
+        self.indexes = dict()  # 列 -> {值 -> 行的列表}
+        for columns in indexes:
+            index = dict()
+            for r in rows:
+                index.setdefault(tuple(r.get(c) for c in columns), []).append(r)
+            self.indexes[columns] = index
+        self.types = dict()  # 列 -> 第一个不是 NULL 的值的类型
+        for r in rows:
+            for c, v in r.items():
+                if v is not None and c not in self.types:
+                    self.types[c] = type(v)
+
+    def find(self, columns, values):
+        """
+        the rows whose columns equal to the values
+        :param columns: tuple of column names
+        :param values: tuple of values
+        :return: list of rows or None if the values can not be compared in memory, or no row matches a string value
+        """
+        for c, v in zip(columns, values):
+            t = self.types.get(c)
+            if v is not None and t is not None and not isinstance(v, t):
+                return None  # 类型不同的比较由 MySQL 完成
+        index = self.indexes.get(columns)
+        if index is not None:
+            try:
+                rows = index.get(values, [])
+            except TypeError:
+                return None
+        else:
+            rows = [r for r in self.rows if all(r.get(c) == v for c, v in zip(columns, values))]
+        if not rows and any(isinstance(v, str) for v in values):
+            return None  # MySQL 的排序规则(例如大小写不敏感)可能找到, 由 MySQL 判断
+        return rows
+
+
+class ReplicatedTable(object):
+
+    """
+    复制到内存中的表. 由模型的 __replicated__ 声明, 例如 __replicated__ = ['category_id', ('kind', 'state')].
+    加载之后, 只有等值条件的查询直接使用快照, 不访问 MySQL. 通过 ORM 写入表(视图是 __base_tables__ 中的表)之后, 快照在重新加载完成之前不再使用.
+    注意字符串使用 Python 的比较, 与 MySQL 的排序规则(例如大小写不敏感)不同: 没有找到的字符串由 MySQL 查询, 但是找到的行可能比 MySQL 少
+    """
+
+    def __init__(self, model, indexes=()):
+        """
+        create the replica of a model
+        :param model: the model class
+        :param indexes: names of the fields (or tuples of names) to build hash indexes on. the primary keys are always indexed
+        """
+        self.model = model
+        self.tables = ()  # 写入之后需要重新加载的表, 参考 make_replica
+        columns = []
+        primary_keys = tuple(getattr(model, '__primary_keys__', ()))
+        if primary_keys:
+            columns.append(primary_keys)
+        for index in indexes:
+            names = (index, ) if isinstance(index, str) else tuple(index)
+            columns.append(tuple(model._column_label(n) for n in names))
+        self.index_columns = list(dict.fromkeys(columns))
+        self.snapshot = None
+        self.dbm = None
+        self.version = 0  # 写入的次数, 用于判断加载的过程中是否有写入
+        self.stale = True
+        self._refreshing = None
+        self._periodic = None
+        self._conditions = dict()  # where -> 列或者 None
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    async def load(self, dbm):
+        """
+        read the whole table and swap the snapshot
+        :param dbm: SQLManager's instance, it is kept for the refreshes after writes
+        :return: number of rows
+        """
+        self.dbm = dbm
+        for _ in range(3):
+            version = self.version
+            rs = await dbm.inner_select(self.model.__select__, [])
+            snapshot = Snapshot([dict(r) for r in rs], self.index_columns)
+            self.loads += 1
+            if version == self.version:  # 加载的过程中有写入, 需要重新加载
+                self.snapshot, self.stale = snapshot, False  # 读取的一方只使用 self.snapshot 的引用, 替换是原子的
+                _replicated_logger.debug('Load %d row(s) of %s' % (len(snapshot.rows), self.model.__name__))
+                return len(snapshot.rows)
+        _replicated_logger.warning('%s is written during loading, the snapshot is not used until the next reload' % self.model.__name__)
+        return len(snapshot.rows)
+
+    def invalidate(self):
+        """
+        called after the table is written through the ORM. queries go to MySQL until the snapshot is reloaded
+        :return:
+        """
+        self.version += 1
+        self.stale = True
+        if self.dbm is not None and (self._refreshing is None or self._refreshing.done()):
+            self._refreshing = self.dbm.loop.create_task(self._reload())
+
+    async def _reload(self):
+        try:
+            await self.load(self.dbm)
+        except Exception as e:
+            _replicated_logger.warning('Failed to reload %s: %s' % (self.model.__name__, e))
+
+    async def _refresh_periodically(self, interval):
+        while True:
+            await sleep(interval)
+            await self._reload()
+
+    def start(self, dbm, interval):
+        """
+        reload the snapshot every interval seconds, e.g. for the tables written outside this process
+        :param dbm: SQLManager's instance
+        :param interval: seconds
+        :return:
+        """
+        self.dbm = dbm
+        self.stop()
+        self._periodic = dbm.loop.create_task(self._refresh_periodically(interval))
+
+    def stop(self):
+        """
+        stop the periodic and pending reloads
+        :return:
+        """
+        for task in (self._periodic, self._refreshing):
+            if task is not None and not task.done():
+                task.cancel()
+        self._periodic = None
+
+    def _columns_of(self, where):
+        """
+        parse the where clause
+        :param where: where sql
+        :return: tuple of column names or None if it is not simple equality conditions
+        """
+        try:
+            return self._conditions[where]
+        except KeyError:
+            pass
+        columns = ()
+        if where:
+            columns = []
+            for cond in _and.split(where.strip()):
+                m = _equality.match(cond)
+                if m is None:
+                    columns = None
+                    break
+                try:
+                    columns.append(self.model._column_label(m.group(1)))
+                except ValueError:
+                    columns = None
+                    break
+            columns = tuple(columns) if columns is not None else None
+        if len(self._conditions) < 1024:
+            self._conditions[where] = columns
+        return columns
+
+    def find(self, columns, values):
+        """
+        find the rows in the snapshot
+        :param columns: tuple of column names
+        :param values: values of the columns
+        :return: list of rows (do not modify them) or None if the query must be executed by MySQL
+        """
+        snapshot = self.snapshot
+        rows = None
+        if snapshot is not None and not self.stale:
+            rows = snapshot.find(columns, tuple(values))
+        if rows is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return rows
+
+    def lookup(self, where, args):
+        """
+        serve the query from the snapshot
+        :param where: where sql, the placeholder is ?
+        :param args: arguments for placeholders
+        :return: list of rows (do not modify them) or None if the query must be executed by MySQL
+        """
+        columns = self._columns_of(where)
+        args = tuple(args) if args else ()
+        if columns is None or len(columns) != len(args):
+            self.misses += 1
+            return None
+        if not columns:
+            if self.snapshot is None or self.stale:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self.snapshot.rows
+        return self.find(columns, args)
+
+    def stats(self):
+        """
+        counters of this replica
+        :return: dict
+        """
+        snapshot = self.snapshot
+        return {'rows': len(snapshot.rows) if snapshot is not None else None, 'stale': self.stale,
+                'hits': self.hits, 'misses': self.misses, 'loads': self.loads}
@@ -0,0 +1,232 @@
+# coding=utf-8
+__author__ = 'Shu Wang <wangshu214@live.cn>'
+__version__ = '0.0.0.1'
+__all__ = ['Session']
+__doc__ = 'Appointed2 - identity map and unit of work for the ORM'
+from ap_database.orm import Model, ModelMetaclass
+from ap_logger.logger import make_logger
+
+
+_session_logger = make_logger('SESSION')
+
+
+class Session(object):
+
+    """
+    请求范围内的会话. 同一个主键只会读取一次并返回同一个对象; 写入、修改和删除会先保存下来,
+    在 commit 的时候按照类型合并为批量的语句, 在同一个连接的同一个事务中执行
+    """
+
+    def __init__(self, dbm, max_batch_rows=500):
+        """
+        create a session
+        :param dbm: SQLManager's instance
+        :param max_batch_rows: maximum objects in one update or delete statement
+        """
+        self.dbm = dbm
+        self.max_batch_rows = max_batch_rows
+        self._identity = dict()  # (model, primary keys) -> object
+        self._new = dict()  # id(object) -> object to insert. 主键可能还没有设置(自增或者默认值), 不能作为键
+        self._deleted = dict()  # (model, primary keys) -> object to delete
+
+    @staticmethod
+    def _key_of(obj):
+        return type(obj), obj._primary_key_values()
+
+    @staticmethod
+    def _has_key(key):
+        return None not in key[1]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.commit()
+        else:
+            self.rollback()
+
+    def __contains__(self, obj):
+        return self._identity.get(self._key_of(obj)) is obj
+
+    async def get(self, model_type, **primary_keys):
+        """
+        find an object by primary keys. the same instance is returned for the same keys in this session
+        :param model_type: subclass of Model
+        :param primary_keys:
+        :return: object or None
+        """
+        key = (model_type, tuple(primary_keys.get(k) for k in model_type.__primary_keys__))
+        obj = self._identity.get(key)  # 删除之后又 add 的对象也在其中
+        if obj is None:
+            if key in self._deleted:
+                return None
+            obj = await self.dbm.query(model_type, **primary_keys)
+            if obj is not None:
+                self._identity[key] = obj
+        return obj
+
+    async def query_all(self, model_type, sql_where=None, args=None, **kwargs):
+        """
+        same as SQLManager.queryAll. the objects of Model are merged into the identity map,
+        an object already in this session is returned instead of the new one
+        :return: list of objects
+        """
+        objs = await self.dbm.queryAll(model_type, sql_where=sql_where, args=args, **kwargs)
+        if not isinstance(model_type, ModelMetaclass) or not isinstance(objs, list):
+            return objs
+        result = []
+        for obj in objs:
+            if not isinstance(obj, Model):
+                return objs  # compact rows
+            key = self._key_of(obj)
+            if key in self._identity:
+                result.append(self._identity[key])
+            elif key not in self._deleted:
+                result.append(self._identity.setdefault(key, obj))
+        return result
+
+    def add(self, obj):
+        """
+        insert the object when commit. adding an object of this session does nothing, its changes are updated when commit.
+        adding a new object whose primary keys are deleted in this session replaces the row: delete first, then insert
+        :param obj: instance of Model
+        :return:
+        """
+        if not isinstance(obj, Model):
+            raise ValueError(str(obj) + '不是 "Model"的一个实例。')
+        key = self._key_of(obj)
+        if not self._has_key(key):
+            self._new[id(obj)] = obj  # 写入之后才知道主键, 不放入 identity map
+            return
+        if self._identity.get(key) is obj:
+            return  # 已经由这个会话管理
+        if self._deleted.get(key) is obj:
+            del self._deleted[key]  # 取消删除
+        else:
+            self._new[id(obj)] = obj
+        self._identity[key] = obj
+
+    def delete(self, obj):
+        """
+        delete the object when commit
+        :param obj: instance of Model
+        :return:
+        """
+        if self._new.pop(id(obj), None) is not None:
+            if self._identity.get(self._key_of(obj)) is obj:
+                del self._identity[self._key_of(obj)]
+            return
+        key = self._key_of(obj)
+        self._identity.pop(key, None)
+        self._deleted[key] = obj
+
+    def expunge(self, obj):
+        """
+        remove the object from this session, its changes will not be saved
+        :param obj:
+        :return:
+        """
+        key = self._key_of(obj)
+        if self._identity.get(key) is obj:
+            del self._identity[key]
+        self._new.pop(id(obj), None)
+        if self._deleted.get(key) is obj:
+            del self._deleted[key]
+
+    @property
+    def dirty(self):
+        """
+        objects loaded in this session and changed since then
+        :return: list
+        """
+        return [obj for obj in self._identity.values() if id(obj) not in self._new and obj._changed]
+
+    def _statements(self):
+        """
+        merge the pending changes into batched statements
+        :return: list of (sql, args, objects)
+        """
+        statements = []
+        # 被新的对象替换的行先删除, 否则写入的时候主键重复
+        replaced = set(self._key_of(obj) for obj in self._new.values()) & set(self._deleted.keys())
+        deletes = dict()
+        for key, obj in self._deleted.items():
+            if key in replaced:
+                deletes.setdefault(type(obj), []).append(obj)
+        statements.extend(self._delete_statements(deletes))
+        inserts = dict()
+        for obj in self._new.values():
+            inserts.setdefault(type(obj), []).append(obj)
+        for model_type, objs in inserts.items():
+            for sql, args, batch in model_type._iter_batches(objs, model_type.__insert_head__):
+                statements.append((sql, args, batch))
+        updates = dict()
+        for obj in self.dirty:
+            fields = tuple(f for f in obj.__fields__ if f in obj._changed)
+            if fields:
+                updates.setdefault((type(obj), fields), []).append(obj)
+        for (model_type, fields), objs in updates.items():
+            for i in range(0, len(objs), self.max_batch_rows):
+                batch = objs[i:i + self.max_batch_rows]
+                sql, args = model_type._update_many_statement(batch, fields)
+                statements.append((sql, args, batch))
+        deletes = dict()
+        for key, obj in self._deleted.items():
+            if key not in replaced:
+                deletes.setdefault(type(obj), []).append(obj)
+        statements.extend(self._delete_statements(deletes))
+        return statements
+
+    def _delete_statements(self, deletes):
+        """
+        batched delete statements
+        :param deletes: dict, model -> objects
+        :return: list of (sql, args, objects)
+        """
+        statements = []
+        for model_type, objs in deletes.items():
+            for i in range(0, len(objs), self.max_batch_rows):
+                batch = objs[i:i + self.max_batch_rows]
+                sql, args = model_type._delete_many_statement(batch)
+                statements.append((sql, args, batch))
+        return statements
+
+    async def flush(self):
+        """
+        write all the pending changes on one connection in one transaction
+        :return: list of affected rows of every statement
+        """
+        statements = self._statements()
+        if not statements:
+            return []
+        await self.dbm.ensureConnected()
+        results = await self.dbm.inner_execute_many([(sql, args) for sql, args, _ in statements])
+        _session_logger.debug('Flush %d statement(s), affected row(s): %s' % (len(results), results))
+        for _, _, batch in statements:
+            for obj in batch:
+                obj._mark_clean()
+            type(batch[0])._after_write(batch, self.dbm)
+        for obj in self._new.values():
+            key = self._key_of(obj)
+            if self._has_key(key):
+                self._identity.setdefault(key, obj)  # 自增的主键仍然未知的对象不再由这个会话管理
+        self._new.clear()
+        self._deleted.clear()
+        return results
+
+    async def commit(self):
+        """
+        flush the pending changes
+        :return: list of affected rows of every statement
+        """
+        return await self.flush()
+
+    def rollback(self):
+        """
+        discard the pending changes and forget all the objects
+        :return:
+        """
+        self._identity.clear()
+        self._new.clear()
+        self._deleted.clear()
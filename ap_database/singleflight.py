@@ -0,0 +1,65 @@
+# coding=utf-8
+__author__ = 'Shu Wang <wangshu214@live.cn>'
+__version__ = '0.0.0.1'
+__all__ = ['SingleFlight']
+__doc__ = 'Appointed2 - coalesce identical in-flight calls'
+from asyncio import shield, CancelledError
+
+
+class SingleFlight(object):
+
+    """
+    相同的键同时只有一个调用在执行, 其他的调用者等待并共享它的结果或者异常.
+    调用者被取消不会影响其他的调用者; 所有的调用者都被取消之后才取消执行中的调用
+    """
+
+    def __init__(self, loop):
+        """
+        create a group of calls
+        :param loop: event loop
+        """
+        self.loop = loop
+        self._calls = dict()  # key -> [task, number of waiters]
+        self.executed = 0  # 实际执行的调用
+        self.coalesced = 0  # 共享了其他调用的结果的调用
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key, coro_factory):
+        """
+        run the coroutine created by coro_factory, or wait for the in-flight one with the same key
+        :param key: hashable key
+        :param coro_factory: callable which returns a coroutine
+        :return: result of the coroutine. it is shared by all the callers, do not modify it
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = [self.loop.create_task(coro_factory()), 0]
+            self._calls[key] = call
+            call[0].add_done_callback(lambda _: self._forget(key, call))
+            self.executed += 1
+        else:
+            self.coalesced += 1
+        call[1] += 1
+        try:
+            return await shield(call[0])
+        except CancelledError:
+            if call[1] == 1 and not call[0].done():
+                call[0].cancel()  # 没有其他的调用者在等待
+                self._forget(key, call)  # 取消可能需要多轮事件循环才完成, 新的调用者不能加入这个调用
+            raise
+        finally:
+            call[1] -= 1
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+    def stats(self):
+        """
+        counters of the calls
+        :return: dict
+        """
+        return {'executed': self.executed, 'coalesced': self.coalesced, 'in_flight': len(self._calls)}
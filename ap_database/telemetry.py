@@ -0,0 +1,185 @@
+# coding=utf-8
+__author__ = 'Shu Wang <wangshu214@live.cn>'
+__version__ = '0.0.0.1'
+__all__ = ['Histogram', 'PoolMonitor']
+__doc__ = 'Appointed2 - histograms and gauges of the connection pools'
+from bisect import bisect_left
+from time import monotonic
+from weakref import WeakKeyDictionary
+
+import sys
+if sys.version_info[:2] <= (3, 6):
+    from async_generator import asynccontextmanager  # for python 3.6
+else:
+    from contextlib import asynccontextmanager  # python3.7
+
+
+# 默认的桶的上界, 单位是秒
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+
+    """
+    固定桶的直方图. 分位数使用所在的桶的上界估计
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        create a histogram
+        :param buckets: increasing upper bounds of the buckets, the last bucket (+inf) is added automatically
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """
+        record a value
+        :param value: seconds
+        :return:
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        estimate the quantile
+        :param q: 0 ~ 1
+        :return: upper bound of the bucket, the maximum for the last bucket, None if empty
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def stats(self):
+        """
+        summary of the histogram
+        :return: dict: count, sum, mean, max, p50, p95, p99 and cumulative buckets (upper bound -> count)
+        """
+        cumulative, seen = dict(), 0
+        for bound, n in zip(self.buckets + (float('inf'), ), self.counts):
+            seen += n
+            cumulative[bound] = seen
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': cumulative
+        }
+
+
+class PoolMonitor(object):
+
+    """
+    记录一个连接池的获取连接的等待时间、持有连接的时间、使用中以及等待中的数量和它们的最高值,
+    以及每一个连接第一次被获取的时间. 连接池按需打开连接, 这个时间接近连接创建的时间
+    """
+
+    def __init__(self, pool):
+        """
+        monitor a pool
+        :param pool: aiomysql pool
+        """
+        self.pool = pool
+        self.wait_time = Histogram()
+        self.hold_time = Histogram()
+        self.in_use = 0
+        self.waiting = 0
+        self.in_use_high = 0
+        self.waiting_high = 0
+        self.acquires = 0
+        self.failures = 0  # 获取连接失败或者被取消
+        self._opened = WeakKeyDictionary()  # 连接 -> 第一次被获取的时间, 参考 touch
+
+    @asynccontextmanager
+    async def acquire(self):
+        """
+        get a connection from the pool and record the time
+        :return: async context manager of the connection
+        """
+        start = monotonic()
+        self.waiting += 1
+        self.waiting_high = max(self.waiting_high, self.waiting)
+        acquired = None
+        try:
+            async with self.pool.acquire() as conn:
+                acquired = self.touch(conn)
+                self.waiting -= 1
+                self.wait_time.observe(acquired - start)
+                self.acquires += 1
+                self.in_use += 1
+                self.in_use_high = max(self.in_use_high, self.in_use)
+                try:
+                    yield conn
+                finally:
+                    self.in_use -= 1
+                    self.hold_time.observe(monotonic() - acquired)
+        finally:
+            if acquired is None:
+                self.waiting -= 1
+                self.failures += 1
+
+    def touch(self, conn):
+        """
+        record the first time the connection is seen, without counting an acquire. used by the housekeeping of the pool
+        :param conn: connection of the pool
+        :return: the current time of monotonic
+        """
+        now = monotonic()
+        if conn not in self._opened:
+            self._opened[conn] = now
+        return now
+
+    def age(self, conn):
+        """
+        seconds since the connection is first seen by this monitor
+        :param conn: connection of the pool
+        :return: seconds, 0 for the unknown connections
+        """
+        opened = self._opened.get(conn)
+        return monotonic() - opened if opened is not None else 0.0
+
+    def reset_high_water(self):
+        """
+        reset the high-water marks to the current values
+        :return:
+        """
+        self.in_use_high = self.in_use
+        self.waiting_high = self.waiting
+
+    def stats(self):
+        """
+        gauges and histograms of the pool
+        :return: dict
+        """
+        pool = self.pool
+        return {
+            'size': pool.size,
+            'free': pool.freesize,
+            'minsize': pool.minsize,
+            'maxsize': pool.maxsize,
+            'in_use': self.in_use,
+            'waiting': self.waiting,
+            'in_use_high': self.in_use_high,
+            'waiting_high': self.waiting_high,
+            'acquires': self.acquires,
+            'failures': self.failures,
+            'wait_time': self.wait_time.stats(),
+            'hold_time': self.hold_time.stats()
+        }
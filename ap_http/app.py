@@ -46,6 +46,9 @@ class BaseHttpApp(Application):
         else:
             self.middlewares.extend(middlewares)  # iterable
 
+    def add_startup_signal(self, signal_callback):
+        self.on_startup.append(signal_callback)
+
     def add_shutdown_signal(self, signal_callback):
         self.on_shutdown.append(signal_callback)
 
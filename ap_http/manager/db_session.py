@@ -0,0 +1,38 @@
+# coding=utf-8
+from ap_http.middlewares import Middleware
+from ap_logger.logger import make_logger
+__author__ = 'Shu Wang <wangshu214@live.cn>'
+__version__ = '0.0.0.1'
+__all__ = ['DatabaseSessionMiddleware']
+__doc__ = 'Appointed2 - attach an ORM session to every request'
+
+
+_db_session_logger = make_logger('DB-SESSION')
+
+
+class DatabaseSessionMiddleware(Middleware):
+
+    def __init__(self, dbmgr, auto_commit=True):
+        """
+        DatabaseSession ctor. the session is available as request.__session__
+        :param dbmgr: ap_database manager, must be instance of DatabaseManager
+        :param auto_commit: commit the session after the handler returns without exception
+        :return:
+        """
+        self.dbmgr = dbmgr
+        self.auto_commit = auto_commit
+        super(DatabaseSessionMiddleware, self).__init__()
+
+    async def __call__(self, request, handler):
+        session = self.dbmgr.session()
+        request.__session__ = session
+        try:
+            response = await handler(request)
+        except BaseException:
+            session.rollback()
+            raise
+        if self.auto_commit:
+            results = await session.commit()
+            if results:
+                _db_session_logger.debug('Commit the session of \'%s\', affected row(s): %s' % (request.path, results))
+        return response
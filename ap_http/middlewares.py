@@ -192,6 +192,8 @@ class ResponseMiddleware(Middleware):
         :param obj: object to dump
         :return: serialize-able obj
         """
+        if hasattr(obj, 'to_dict') and callable(obj.to_dict):
+            return obj.to_dict()  # compact rows of ORM
         if obj and hasattr(obj, '__dict__') and callable(obj.__dict__):
             return obj.__dict__()
         else:
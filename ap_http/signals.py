@@ -2,7 +2,7 @@
 __author__ = 'Shu Wang <wangshu214@live.cn>'
 __version__ = '0.0.0.1'
 __all__ = []
-__doc__ = 'Appointed2 - shutdown signals'
+__doc__ = 'Appointed2 - startup and shutdown signals'
 
 
 def make_shutdown_sqlmanager_signal(sqlmanager):
@@ -14,3 +14,42 @@ def make_shutdown_sqlmanager_signal(sqlmanager):
     async def on_shutdown(app):
         await sqlmanager.close()
     return on_shutdown
+
+
+def make_check_indexes_signal(sqlmanager, models, sync=False):
+    """
+    check the indexes declared by the models when the app starts, the missing ones are logged as warnings
+    :param sqlmanager: SQLManager's instance
+    :param models: list of the subclasses of Model
+    :param sync: create the missing indexes
+    :return:
+    """
+    async def on_startup(app):
+        await sqlmanager.checkIndexes(models, sync=sync)
+    return on_startup
+
+
+def make_load_replicated_signal(sqlmanager, models, refresh_interval=None):
+    """
+    load the replicated tables into memory when the app starts
+    :param sqlmanager: SQLManager's instance
+    :param models: list of the models which declare __replicated__
+    :param refresh_interval: seconds, reload the tables periodically
+    :return:
+    """
+    async def on_startup(app):
+        await sqlmanager.loadReplicated(models, refresh_interval=refresh_interval)
+    return on_startup
+
+
+def make_warm_up_sqlmanager_signal(sqlmanager, keepalive_interval=None, **kwargs):
+    """
+    create the SQL connection pool and open its connections when the app starts
+    :param sqlmanager: SQLManager's instance
+    :param keepalive_interval: seconds, ping the idle connections periodically
+    :param kwargs: arguments of connect, e.g. minsize, maxsize
+    :return:
+    """
+    async def on_startup(app):
+        await sqlmanager.warm_up(keepalive_interval=keepalive_interval, **kwargs)
+    return on_startup
@@ -25,7 +25,7 @@ def make_app(dbusername, dbpasswd, dbname, dbhost, dbport, log_level='info'):
     from ap_database.dbmgr import MySQLManager
     from ap_http.middlewares import make_middleware_wrap
     from ap_http.middlewares import Jinja2TemplateResponseMiddleware
-    from ap_http.signals import make_shutdown_sqlmanager_signal
+    from ap_http.signals import make_shutdown_sqlmanager_signal, make_check_indexes_signal, make_warm_up_sqlmanager_signal
     from model import User
 
     dbm = MySQLManager(username=dbusername, password=dbpasswd, dbname=dbname, host=dbhost, port=dbport)
@@ -34,6 +34,8 @@ def make_app(dbusername, dbpasswd, dbname, dbhost, dbport, log_level='info'):
 
     server.add_middleware([make_middleware_wrap(Jinja2TemplateResponseMiddleware(templates_dir='./templates'))])
     server.add_kwargs_to_route(dbm=dbm, sb='TOO YOUNG')
+    server.add_startup_signal(make_warm_up_sqlmanager_signal(dbm))
+    server.add_startup_signal(make_check_indexes_signal(dbm, [User]))
     server.add_shutdown_signal(make_shutdown_sqlmanager_signal(dbm))
     return server
 
@@ -1,4 +1,4 @@
-from ap_database.orm import Model, StringField, FloatField
+from ap_database.orm import Model, StringField, FloatField, Index
 
 import time
 
@@ -6,6 +6,7 @@ import time
 class User(Model):
 
     __table__ = 'users'  # 表的位置
+    __indexes__ = [Index('created_time')]  # 启动的时候检查索引是否存在
     passwd = StringField(column_type='varchar(50)')
     username = StringField(column_type='varchar(50)', primary_key=True)
     created_time = FloatField(default=time.time)
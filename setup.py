@@ -13,5 +13,6 @@ setup(name='appointed2',
           url='https://ddayzzz.wang',
           packages=['ap_database', 'ap_deploy', 'ap_http', 'ap_logger', 'ap_http.manager'],
           install_requires=deps,
+          extras_require={'columnar': ['numpy']},
           python_requires='>=3.6')
 